@@ -20,6 +20,8 @@ Here a brief description of all the modules and packages available:
                 modules 'aligner' and 'xenograft'.
     * aligner - The module responsible for the alignment of the fastq
                 files.
+    * samfilter - The module used to filter the aligned reads before
+                  the conversion to BAM.
     * xenograft - When a sample derives from xenotransplanted tissues,
                   this module is used in order to split the data between
                   graft and host.
@@ -9,10 +9,14 @@ import os
 import shutil
 import tempfile
 from enum import Enum, auto
+from fractions import Fraction
+from typing import Any, BinaryIO, Iterable, List, Optional
 
+from . import samfilter
 from .core import utils
 from .core.analysis import Analysis
 from .core.barcoded_filename import Analyte, BarcodedFilename
+from .core.exceptions import PipelineError
 from .core.executor import Executor
 
 
@@ -29,6 +33,12 @@ class RnaSeqAligner(Enum):
     STAR = auto()
 
 
+class _NovoalignLogSection(Enum):
+    NONE = auto()
+    STATS = auto()
+    FRAGMENT_LENGTHS = auto()
+
+
 class Aligner:
     """The class responsible for the alignment with various software.
 
@@ -38,27 +48,83 @@ class Aligner:
     also used freely.
     """
 
-    def __init__(self, analysis: Analysis) -> None:
-        """Create an instance of the Aligner."""
+    def __init__(
+        self, analysis: Analysis, max_mismatches: Optional[Fraction] = None
+    ) -> None:
+        """Create an instance of the Aligner.
+
+        Args:
+            analysis: the analysis to perform the alignment for.
+            max_mismatches: when set, the aligners supporting it stream
+                            their output through `samfilter.filter_sam`,
+                            using this fraction of mismatches, and then
+                            to Samtools, producing a BAM file without an
+                            intermediate SAM. In this case
+                            `filtered_to_bam` is set after the
+                            alignment.
+        """
         self.analysis = analysis
+        self.max_mismatches = max_mismatches
+        self.filtered_to_bam = False
         self.output_basename = os.path.join("REPORTS", self.analysis.basename)
         self.only_human = True
 
         self.max_records_str = utils.get_picard_max_records_string(
             self.analysis.parameters["picard_max_records"]
         )
+        self.deflater_str = utils.get_picard_deflater_string(
+            self.analysis.config.picard_jdk_deflater
+        )
         self.sort_tempdir = os.path.join(
             self.analysis.get_bam_dir(), "%s_sort_tmp" % self.analysis.sample
         )
+        self.gatk_threads = self.analysis.parameters["gatk_threads"]
 
     def chdir(self) -> None:
         """Change current directory to the BAM folder."""
         os.chdir(self.analysis.get_bam_dir())
 
+    def _align_to_bam(self, command: str, **kwargs: Any) -> None:
+        config = self.analysis.config
+        logger = self.analysis.logger
+        output_filename = kwargs["output_filename"]
+        max_mismatches = self.max_mismatches
+        assert max_mismatches is not None
+        aligner_statuses: List[int] = []
+
+        def stream_alignment(sam_fd: BinaryIO, bam_fd: BinaryIO) -> None:
+            if kwargs["organism"].startswith("hg"):
+                samfilter.filter_sam(sam_fd, bam_fd, max_mismatches)
+            else:
+                shutil.copyfileobj(sam_fd, bam_fd, samfilter.COPY_CHUNK_SIZE)
+
+        def write_alignment(bam_fd: BinaryIO) -> None:
+            aligner_statuses.append(
+                utils.run_and_log_reading(
+                    command, logger, lambda sam_fd: stream_alignment(sam_fd, bam_fd)
+                )
+            )
+
+        status = utils.run_and_log_piped(
+            f"{config.samtools} view -@ {self.gatk_threads} -b "
+            f'-o "{output_filename}" -',
+            logger,
+            write_alignment,
+        )
+        if status != 0:
+            logger.error("samtools view exited with status %d", status)
+            raise PipelineError("samtools view error")
+
+        if aligner_statuses != [0]:
+            logger.error("Aligner exited with status %s", aligner_statuses)
+            raise PipelineError("aligner error")
+
     def novoalign(self) -> None:
         """Run Novoalign aligner.
 
-        The output statistics are collected into two CSVs.
+        The output statistics are collected into two CSVs. When
+        `max_mismatches` is set, the alignment is filtered and converted
+        to BAM while Novoalign is running.
 
         At to date, Novoalign can be used to run whole exome and gene
         panel data alignment.
@@ -73,28 +139,27 @@ class Aligner:
             fh = logging.FileHandler(filename)
             self.analysis.logger.addHandler(fh)
             if barcoded.analyte == Analyte.WHOLE_EXOME:
-                executor(
-                    f"{config.novoalign} "
+                novoalign_args = (
                     f'-oSAM "@RG\tID:{self.analysis.basename}\t'
                     f'SM:{self.analysis.sample}\tLB:lib1\tPL:ILLUMINA" '
                     f"-d {{genome_index}} "
                     f"-i PE {{kit.mean_len_library}},{{kit.sd_len_library}} "
-                    f"-t 90 -f {{input_filename}}> {{output_filename}}",
-                    input_function=lambda l: " ".join(sorted(l)),
-                    input_split_reads=False,
-                    output_format=f"{self.analysis.basename}{{organism_str}}.sam",
-                    split_by_organism=True,
-                    only_human=self.only_human,
-                    unlink_inputs=True,
+                    f"-t 90"
                 )
             elif barcoded.analyte == Analyte.GENE_PANEL:
-                executor(
-                    f"{config.novoalign} "
+                novoalign_args = (
                     f"-C "
                     f'-oSAM "@RG\tID:{self.analysis.basename}\t'
                     f'SM:{self.analysis.sample}\tLB:lib1\tPL:ILLUMINA" '
                     f"-d {{genome_index}} "
-                    f"-i 50-500 -h 8 -H 20 --matchreward 3 -t 90 "
+                    f"-i 50-500 -h 8 -H 20 --matchreward 3 -t 90"
+                )
+            else:
+                raise Exception("Unnhandled analyte")
+
+            if self.max_mismatches is None:
+                executor(
+                    f"{config.novoalign} {novoalign_args} "
                     f"-f {{input_filename}}> {{output_filename}}",
                     input_function=lambda l: " ".join(sorted(l)),
                     input_split_reads=False,
@@ -104,44 +169,63 @@ class Aligner:
                     unlink_inputs=True,
                 )
             else:
-                raise Exception("Unnhandled analyte")
+                executor(
+                    lambda **kwargs: self._align_to_bam(
+                        f"{config.novoalign} {novoalign_args.format(**kwargs)} "
+                        f"-f {kwargs['input_filename']}",
+                        **kwargs,
+                    ),
+                    input_function=lambda l: " ".join(sorted(l)),
+                    input_split_reads=False,
+                    output_format=f"{self.analysis.basename}{{organism_str}}.bam",
+                    split_by_organism=True,
+                    only_human=self.only_human,
+                    unlink_inputs=True,
+                )
+                self.filtered_to_bam = True
+
             #  CSV NOVOALIGN
-            with open(filename, "r") as file_log, open(
-                self.output_basename + "_novoalign.csv", "w"
-            ) as csv_file, open(
-                self.output_basename + "_stat_novoalign.csv", "w"
-            ) as stat_csv_file:
-                writer = csv.writer(csv_file)
-                writer_stat = csv.writer(stat_csv_file)
-                is_csv = False
-                is_stat = False
-                values = []
-                labels = []
+            section = _NovoalignLogSection.NONE
+            values = []
+            labels = []
+            fragment_rows = []
+            with open(filename, "r") as file_log:
                 for line in file_log:
-                    fields = line.split(":")
-                    label = fields[0][1:].strip()
-
-                    if is_stat is True:
-                        if label == "No Mapping Found":
-                            is_stat = False
-                        values.append(fields[1].strip().split()[0])
-                        labels.append(label)
-                    elif label == "Paired Reads":
-                        values.append(fields[1].strip().split()[0])
+                    head, _, tail = line.partition(":")
+                    label = head[1:].strip()
+
+                    if (
+                        section == _NovoalignLogSection.STATS
+                        or label == "Paired Reads"
+                    ):
+                        values.append(tail.split(None, 1)[0])
                         labels.append(label)
-                        is_stat = True
-                    else:
-                        fields = line.split()
-                        if is_csv is True:
-                            if fields[1] == "Mean":
-                                break
-                            else:
-                                writer.writerow(fields[1:4])
-                        elif fields[1] == "From":
-                            writer.writerow(fields[1:4])
-                            is_csv = True
-                writer_stat.writerow(labels)
-                writer_stat.writerow(values)
+                        if label == "No Mapping Found":
+                            section = _NovoalignLogSection.NONE
+                        else:
+                            section = _NovoalignLogSection.STATS
+                        continue
+
+                    fields = line.split()
+                    if len(fields) < 2:
+                        continue
+
+                    if section == _NovoalignLogSection.FRAGMENT_LENGTHS:
+                        if fields[1] == "Mean":
+                            break
+                        fragment_rows.append(fields[1:4])
+                    elif fields[1] == "From":
+                        fragment_rows.append(fields[1:4])
+                        section = _NovoalignLogSection.FRAGMENT_LENGTHS
+
+            with open(
+                self.output_basename + "_novoalign.csv", "w", newline=""
+            ) as csv_file:
+                csv.writer(csv_file).writerows(fragment_rows)
+            with open(
+                self.output_basename + "_stat_novoalign.csv", "w", newline=""
+            ) as stat_csv_file:
+                csv.writer(stat_csv_file).writerows([labels, values])
             self.analysis.logger.removeHandler(fh)
             fh.close()
         self.analysis.logger.info("Alignment finished. Aligner used: NovoAlign")
@@ -311,50 +395,143 @@ class Aligner:
         self.analysis.logger.info("Finished HTseq count")
         self.analysis.logger.info("Alignment finished. Aligner used: STAR")
 
-    def sort_bam(self) -> None:
-        """Sort BAM files using Picard.
+    @staticmethod
+    def _get_sequence_names(header: Iterable[str]) -> List[str]:
+        names = []
+        for line in header:
+            if line.startswith("@SQ\t"):
+                for field in line.rstrip("\n").split("\t")[1:]:
+                    if field.startswith("SN:"):
+                        names.append(field[3:])
+                        break
+        return names
+
+    def _needs_reorder(self, bam_filename: str, genome_ref: str) -> bool:
+        dict_filename = os.path.splitext(genome_ref)[0] + ".dict"
+        if not os.path.exists(dict_filename):
+            return True
 
-        Picard SortSam and Picard ReorderSam are used. A temporary
-        directory is used during the process, and it is cleaned up at
-        the end.
-        """
-        self.analysis.logger.info("Sorting BAM(s)")
-        self.chdir()
         config = self.analysis.config
+        logger = self.analysis.logger
+        bam_names: List[str] = []
+        status = utils.run_and_log_reading(
+            f'{config.samtools} view -H "{bam_filename}"',
+            logger,
+            lambda stdout: bam_names.extend(
+                self._get_sequence_names(line.decode() for line in stdout)
+            ),
+        )
+        if status != 0:
+            logger.error("samtools view exited with status %d", status)
+            raise PipelineError("samtools view error")
 
-        os.makedirs(self.sort_tempdir, exist_ok=True)
+        with open(dict_filename) as dict_file:
+            dict_names = self._get_sequence_names(dict_file)
+        return not bam_names or bam_names != dict_names
 
-        executor = Executor(self.analysis)
-        executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"SortSam "
-            f"I={{input_filename}} "
-            f"O={{output_filename}} SO=coordinate "
-            f"TMP_DIR={self.sort_tempdir}"
-            f"{self.max_records_str}",
-            output_format=f"{self.analysis.basename}.srt{{organism_str}}.bam",
-            error_string="Picard SortSam exited with status {status}",
-            exception_string="picard SortSam error",
-            only_human=self.only_human,
-            split_by_organism=True,
-            unlink_inputs=True,
+    def _samtools_sort(self, **kwargs: Any) -> None:
+        config = self.analysis.config
+        logger = self.analysis.logger
+        input_filename = kwargs["input_filename"].filename
+        output_filename = kwargs["output_filename"]
+        index_filename = output_filename[:-4] + ".bai"
+
+        status = utils.run_and_log(
+            f"{config.samtools} collate -@ {self.gatk_threads} -O -u "
+            f'"{input_filename}" {self.sort_tempdir}/collate | '
+            f"{config.samtools} fixmate -@ {self.gatk_threads} -m -u - - | "
+            f"{config.samtools} sort -@ {self.gatk_threads} "
+            f"-T {self.sort_tempdir}/srt --write-index "
+            f'-o "{output_filename}##idx##{index_filename}" -',
+            logger,
         )
+        if status != 0:
+            logger.error("samtools sort exited with status %d", status)
+            raise PipelineError("samtools sort error")
 
-        executor(
+        if not self._needs_reorder(output_filename, kwargs["genome_ref"]):
+            return
+
+        reorder_filename = output_filename[:-4] + ".reorder.bam"
+        status = utils.run_and_log(
             f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
             f"ReorderSam "
-            f"I={{input_filename}} "
-            f"O={{output_filename}} R={{genome_ref}} "
+            f"I={output_filename} "
+            f"O={reorder_filename} R={kwargs['genome_ref']} "
             f"CREATE_INDEX=true"
-            f"{self.max_records_str}",
-            output_format=f"{self.analysis.basename}"
-            f".srt.reorder{{organism_str}}.bam",
-            error_string="Picard ReorderSam exited with status {status}",
-            exception_string="picard ReorderSam error",
-            only_human=self.only_human,
-            split_by_organism=True,
-            unlink_inputs=True,
+            f"{self.max_records_str}"
+            f"{self.deflater_str}",
+            logger,
         )
+        if status != 0:
+            logger.error("Picard ReorderSam exited with status %d", status)
+            raise PipelineError("picard ReorderSam error")
+
+        os.replace(reorder_filename, output_filename)
+        os.replace(reorder_filename[:-4] + ".bai", index_filename)
+
+    def sort_bam(self) -> None:
+        """Sort BAM files using Picard or Samtools.
+
+        By default, Picard SortSam and Picard ReorderSam are used. When
+        the "use_samtools_sort" parameter is set, the reads are grouped
+        by name with Samtools collate, the mate information is fixed by
+        Samtools fixmate, as needed by Samtools markdup, and the result
+        is piped to Samtools sort, which also writes the index. In this
+        case Picard ReorderSam is run only if the sequences of the BAM
+        are not in the same order of the reference dictionary. A
+        temporary directory is used during the process, and it is
+        cleaned up at the end.
+        """
+        self.analysis.logger.info("Sorting BAM(s)")
+        self.chdir()
+        config = self.analysis.config
+
+        os.makedirs(self.sort_tempdir, exist_ok=True)
+
+        executor = Executor(self.analysis)
+        if self.analysis.parameters["use_samtools_sort"]:
+            executor(
+                self._samtools_sort,
+                output_format=f"{self.analysis.basename}.srt{{organism_str}}.bam",
+                only_human=self.only_human,
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
+        else:
+            executor(
+                f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
+                f"SortSam "
+                f"I={{input_filename}} "
+                f"O={{output_filename}} SO=coordinate "
+                f"COMPRESSION_LEVEL={config.picard_intermediate_compression} "
+                f"TMP_DIR={self.sort_tempdir}"
+                f"{self.max_records_str}"
+                f"{self.deflater_str}",
+                output_format=f"{self.analysis.basename}.srt{{organism_str}}.bam",
+                error_string="Picard SortSam exited with status {status}",
+                exception_string="picard SortSam error",
+                only_human=self.only_human,
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
+
+            executor(
+                f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
+                f"ReorderSam "
+                f"I={{input_filename}} "
+                f"O={{output_filename}} R={{genome_ref}} "
+                f"CREATE_INDEX=true"
+                f"{self.max_records_str}"
+                f"{self.deflater_str}",
+                output_format=f"{self.analysis.basename}"
+                f".srt.reorder{{organism_str}}.bam",
+                error_string="Picard ReorderSam exited with status {status}",
+                exception_string="picard ReorderSam error",
+                only_human=self.only_human,
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
 
         if os.path.exists(self.sort_tempdir):
             shutil.rmtree(self.sort_tempdir)
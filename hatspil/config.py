@@ -53,7 +53,15 @@ class Config:
     """
 
     executables = ("java", "java7", "perl", "seqtk", "fastqc", "samtools")
-    optional_executables = ("novoalign", "bwa", "star", "xenome", "disambiguate")
+    optional_executables = (
+        "novoalign",
+        "bwa",
+        "star",
+        "xenome",
+        "disambiguate",
+        "pigz",
+        "fastp",
+    )
     jars = ("picard", "varscan", "gatk", "mutect", "bam2tdf")
     files = (
         "strelka_basedir",
@@ -87,12 +95,16 @@ class Config:
         "xenome_index",
         "xenome_threads",
         "strelka_threads",
+        "executor_jobs",
         "use_hg19",
         "use_hg38",
         "use_mm9",
         "use_mm10",
         "mails",
         "use_mongodb",
+        "use_picard_read_groups",
+        "picard_jdk_deflater",
+        "picard_intermediate_compression",
         "picard_jvm_args",
         "varscan_jvm_args",
         "gatk_jvm_args",
@@ -132,11 +144,11 @@ class Config:
         self.bwa = "bwa"
         self.novoalign = "novoalign"
         self.picard = "picard.jar"
-        self.picard_jvm_args = "-Xmx128g"
+        self.picard_jvm_args = "-Xmx128g -XX:+UseParallelGC"
         self.varscan = "VarScan.jar"
         self.varscan_jvm_args = "-Xmx36g"
         self.gatk = "GenomeAnalysisTK.jar"
-        self.gatk_jvm_args = "-Xmx128g"
+        self.gatk_jvm_args = "-Xmx128g -XX:+UseParallelGC"
         self.seqtk = "seqtk"
         self.fastqc = "fastqc"
         self.mutect = "mutect.jar "
@@ -147,9 +159,12 @@ class Config:
         self.xenome_index = "xenome_idx"
         self.xenome_threads = 1
         self.disambiguate = "disambiguate"
+        self.pigz = "pigz"
+        self.fastp = "fastp"
         self.strelka_basedir = "/usr/share/strelka"
         self.strelka_config = "/usr/share/strelka/config.ini"
         self.strelka_threads = 1
+        self.executor_jobs = 1
         self.annovar_basedir = "/usr/share/annovar"
         self.temporary_dir = "/tmp"
         self.bam2tdf = "bam2tdf.jar"
@@ -172,6 +187,9 @@ class Config:
         self.kits: Dict[Tuple[int, Analyte], KitData] = {}
         self.mails = ""
         self.use_mongodb = True
+        self.use_picard_read_groups = False
+        self.picard_jdk_deflater = False
+        self.picard_intermediate_compression = 1
         self.mongodb_database = "hatspil"
         self.mongodb_username = "hatspil"
         self.mongodb_password = "hatspil"
@@ -205,12 +223,22 @@ class Config:
             for param in (
                 "xenome_threads",
                 "strelka_threads",
+                "executor_jobs",
+                "picard_intermediate_compression",
                 "mean_len_library",
                 "sd_len_library",
             ):
                 if param in parser["PARAMETERS"]:
                     setattr(self, param, parser["PARAMETERS"].getint(param))
-            for param in ("use_hg19", "use_hg38", "use_mm9", "use_mm10", "use_mongodb"):
+            for param in (
+                "use_hg19",
+                "use_hg38",
+                "use_mm9",
+                "use_mm10",
+                "use_mongodb",
+                "use_picard_read_groups",
+                "picard_jdk_deflater",
+            ):
                 if param in parser["PARAMETERS"]:
                     setattr(self, param, parser["PARAMETERS"].getboolean(param))
 
@@ -373,6 +401,12 @@ class Config:
             ):
                 setattr(self, param, None)
 
+        if self.pigz is None:
+            sys.stderr.write(
+                "WARNING: pigz cannot be executed. Compressed files will be "
+                "handled using a single thread.\n"
+            )
+
         return ok
 
     def _check_valid_annotation(self, param: str) -> bool:
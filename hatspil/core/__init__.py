@@ -16,6 +16,9 @@ The modules contained in this package are the following:
     * starter - A helper module needed to bootstrap an analysis.
     * executor - The real core of HaTSPiL. This module contains the
                  class responsible to run each command of the analyses.
+    * executor_graph - A helper module to run independent steps of an
+                       analysis concurrently, respecting their
+                       dependencies.
     * utils - A set of utility functions.
     * ranges - A module useful to perform genomic ranges operations.
     * exceptions - A small set of custom exceptions.
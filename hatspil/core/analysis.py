@@ -51,6 +51,7 @@ class Analysis:
         ] = None
         self.run_fake = False
         self.can_unlink = True
+        self._human_annotation: Optional[str] = None
 
         os.makedirs(self.root, exist_ok=True)
         os.makedirs(self.out_dir, exist_ok=True)
@@ -105,6 +106,17 @@ class Analysis:
         """Get the variant calling output directory for the analysis."""
         return self._get_custom_dir("out_dir")
 
+    @property
+    def human_annotation(self) -> str:
+        """Get the best human genome annotation available in config.
+
+        The value is obtained using `utils.get_human_annotation` the
+        first time it is needed, then it is cached.
+        """
+        if self._human_annotation is None:
+            self._human_annotation = utils.get_human_annotation(self.config)
+        return self._human_annotation
+
     @property
     def using_normals(self) -> bool:
         """Return whether the analysis is using normal tissues.
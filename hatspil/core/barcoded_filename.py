@@ -32,7 +32,7 @@ index for paired-end analyses.
 import os
 import re
 from enum import IntEnum
-from typing import Dict, Optional, Union
+from typing import Dict, Hashable, Optional, Tuple, Union
 
 from .exceptions import BarcodeError
 
@@ -213,6 +213,8 @@ class Xenograft:
     encoding and the decoding.
     """
 
+    re_tissue = re.compile(r"^6[A-Za-z]$")
+
     def __init__(self, generation: int, parent: int, child: int) -> None:
         """Create a Xenograft from the generation, parent and child parameters.
 
@@ -261,7 +263,7 @@ class Xenograft:
         if raw_tissue[0] != "6":
             return None
 
-        if not re.match("^6[A-Za-z]$", raw_tissue):
+        if not Xenograft.re_tissue.match(raw_tissue):
             raise BarcodeError(
                 "old xenograft barcoding detected, unable to "
                 "proceed.\n'6' must be followed by A-Z in case "
@@ -796,6 +798,19 @@ class BarcodedFilename:
         """Check whether the sample is a xenograft."""
         return self.xenograft is not None
 
+    def get_sample_dict(self) -> Dict[str, Union[int, Dict[str, int], None]]:
+        """Get the dict identifying the sample inside its biopsy.
+
+        The dict contains the index of the sample or, in case of a
+        xenograft, the dict representation of the xenograft. The
+        consistency between the tissue and the xenograft is already
+        checked when the instance is created.
+        """
+        if self.xenograft is None:
+            return {"index": self.sample}
+        else:
+            return {"xenograft": self.xenograft.to_dict()}
+
     def equals_without_tissue(self, other: "BarcodedFilename") -> bool:
         """Compare two barcodes ignoring the tissue.
 
@@ -810,3 +825,18 @@ class BarcodedFilename:
             and self.kit == other.kit
             and self.biopsy == other.biopsy
         )
+
+    def key_without_tissue(self) -> Tuple[Hashable, ...]:
+        """Get a hashable key ignoring the tissue.
+
+        Two barcodes have the same key if and only if
+        `equals_without_tissue` returns true for them.
+        """
+        return (
+            self.project,
+            self.patient,
+            self.molecule,
+            self.analyte,
+            self.kit,
+            self.biopsy,
+        )
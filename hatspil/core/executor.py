@@ -8,11 +8,17 @@ of the analysis and a set of customizable parameters.
 For more information, see the `Execution` class.
 """
 
+import functools
+import itertools
+import logging
 import os
-import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
-                    Sequence, Tuple, Union, cast)
+from types import CodeType
+from typing import (Any, Callable, DefaultDict, Dict, Hashable, Iterable,
+                    Iterator, List, Mapping, Optional, Sequence, Tuple, Union,
+                    cast)
 
 from ..config import KitData
 from . import utils
@@ -33,6 +39,19 @@ class AnalysisType(Enum):
     Control = 2
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_barcode(filename: str) -> Optional[BarcodedFilename]:
+    """Return the cached `BarcodedFilename` for a filename, if valid.
+
+    The returned instance is shared between all the callers, therefore
+    it must not be modified.
+    """
+    try:
+        return BarcodedFilename(filename)
+    except Exception:
+        return None
+
+
 class AnalysisFileData:
     """A helper class to cache some file information.
 
@@ -48,18 +67,22 @@ class AnalysisFileData:
     to ease the creation of a command line string.
     """
 
+    __slots__ = ("filename", "barcode", "type")
+
     def __init__(self, filename: str) -> None:
         """Create an `AnalysisFileData`."""
         self.filename = filename
-        try:
-            self.barcode = BarcodedFilename(filename)
-            if self.barcode.tissue.is_normal():
-                self.type = AnalysisType.Control
-            elif self.barcode.tissue.is_tumor():
-                self.type = AnalysisType.Sample
-            else:
-                self.type = AnalysisType.Unspecified
-        except Exception:
+        barcode = _parse_barcode(filename)
+        if barcode is None:
+            self.type = AnalysisType.Unspecified
+            return
+
+        self.barcode = barcode
+        if barcode.tissue.is_normal():
+            self.type = AnalysisType.Control
+        elif barcode.tissue.is_tumor():
+            self.type = AnalysisType.Sample
+        else:
             self.type = AnalysisType.Unspecified
 
     def __repr__(self) -> str:
@@ -67,6 +90,17 @@ class AnalysisFileData:
         return self.filename
 
 
+def _invalidating(method: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap a `list` method to invalidate the `SingleAnalysis` cache."""
+
+    @functools.wraps(method)
+    def wrapper(self: "SingleAnalysis", *args: Any, **kwargs: Any) -> Any:
+        self._classified = False
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class SingleAnalysis(List[AnalysisFileData]):
     """A helper class to get control and sample for an analysis.
 
@@ -74,29 +108,85 @@ class SingleAnalysis(List[AnalysisFileData]):
     to get the one or the other without parsing a list of two files.
     This class extends a list of `AnalysisFileData` in order to easily
     get the sample and the control for an analysis.
+
+    The sample and the control are found with a single scan of the
+    list, which is repeated only after the list is modified.
     """
 
+    __slots__ = ("_classified", "_sample", "_control")
+
+    def __init__(self, *args: Any) -> None:
+        """Create a `SingleAnalysis` like a `list`."""
+        super().__init__(*args)
+        self._classified = False
+        self._sample: Optional[AnalysisFileData] = None
+        self._control: Optional[AnalysisFileData] = None
+
+    append = _invalidating(list.append)
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    remove = _invalidating(list.remove)
+    pop = _invalidating(list.pop)
+    clear = _invalidating(list.clear)
+    sort = _invalidating(list.sort)
+    reverse = _invalidating(list.reverse)
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    __iadd__ = _invalidating(list.__iadd__)
+    __imul__ = _invalidating(list.__imul__)
+
+    def _classify(self) -> None:
+        self._sample = None
+        self._control = None
+        for file_data in self:
+            if file_data.type == AnalysisType.Sample:
+                if self._sample is None:
+                    self._sample = file_data
+            elif file_data.type == AnalysisType.Control:
+                if self._control is None:
+                    self._control = file_data
+        self._classified = True
+
     @property
     def sample(self) -> Optional[AnalysisFileData]:
         """Get the sample file."""
-        return next(
-            (file_data for file_data in self if file_data.type == AnalysisType.Sample),
-            None,
-        )
+        if not self._classified:
+            self._classify()
+        return self._sample
 
     @property
     def control(self) -> Optional[AnalysisFileData]:
         """Get the control file."""
-        return next(
-            (file_data for file_data in self if file_data.type == AnalysisType.Control),
-            None,
-        )
+        if not self._classified:
+            self._classify()
+        return self._control
 
 
 AnalysesPerOrganism = Dict[str, List[SingleAnalysis]]
 
 
 class _ExecutorData:
+    __slots__ = (
+        "command",
+        "output_format",
+        "input_filenames",
+        "input_function",
+        "input_split_reads",
+        "output_path",
+        "output_function",
+        "error_string",
+        "exception_string",
+        "override_last_files",
+        "write_bam_files",
+        "unlink_inputs",
+        "save_only_last",
+        "use_normals",
+        "split_by_organism",
+        "only_human",
+        "split_input_files",
+        "allow_raw_filenames",
+    )
+
     def __init__(
         self,
         command: Union[str, List[str], Callable[..., None]],
@@ -141,6 +231,140 @@ class _ExecutorData:
         self.allow_raw_filenames = allow_raw_filenames
 
 
+class _Template:
+    """A template string split into literals and evaluable arguments.
+
+    The string is scanned once, looking for the text between a pair of
+    curly braces. `segments` contains the literal texts, each one
+    followed by an evaluable argument and its compiled code. The last
+    segment has no evaluable argument, and the code is `None` when the
+    argument cannot be compiled. `simple_names` contains the variable
+    names of the template when all the evaluable arguments are plain
+    names and there are no other curly braces, otherwise it is `None`.
+    Simple templates can be expanded with `str.format_map`.
+    """
+
+    __slots__ = ("string", "segments", "simple_names")
+
+    def __init__(self, s: str) -> None:
+        self.string = s
+        self.segments: List[Tuple[str, Optional[str], Optional[CodeType]]] = []
+
+        start = 0
+        literal_start = 0
+        while True:
+            open_index = s.find("{", start)
+            if open_index == -1:
+                break
+
+            close_index = s.find("}", open_index + 1)
+            if close_index == -1:
+                break
+
+            if close_index == open_index + 1:
+                start = close_index
+                continue
+
+            expression = s[open_index + 1 : close_index]
+            code: Optional[CodeType]
+            try:
+                code = compile(expression, "<template>", "eval")
+            except SyntaxError:
+                code = None
+
+            self.segments.append((s[literal_start:open_index], expression, code))
+            start = literal_start = close_index + 1
+        self.segments.append((s[literal_start:], None, None))
+
+        names = [expression for _, expression, _ in self.segments if expression]
+        self.simple_names: Optional[List[str]] = names
+        if not all(name.isidentifier() for name in names) or any(
+            "{" in literal or "}" in literal for literal, _, _ in self.segments
+        ):
+            self.simple_names = None
+
+    def format(self, env: Mapping[str, Any]) -> str:
+        """Replace the evaluable arguments using `env`."""
+        segments = self.segments
+        if len(segments) == 1:
+            return self.string
+
+        names = self.simple_names
+        if names is not None and all(env.get(name) is not None for name in names):
+            return self.string.format_map(env)
+
+        return "".join(
+            literal
+            if expression is None
+            else literal + str(Executor._evaluate(expression, code, env))
+            for literal, expression, code in segments
+        )
+
+
+def _is_human_organism(organism: Optional[str]) -> bool:
+    """Check if an organism is human, as files without organism are."""
+    return not organism or organism.startswith("hg")
+
+
+def _is_any_organism(organism: Optional[str]) -> bool:
+    return True
+
+
+def _override_str(last_filenames: Any, new_filename: str) -> Any:
+    return new_filename
+
+
+def _override_list(last_filenames: Any, new_filename: str) -> Any:
+    if len(last_filenames) != 1:
+        raise PipelineError(
+            "last operation created a list with a number of output "
+            "files different than one"
+        )
+
+    last_filenames[0] = new_filename
+    return last_filenames
+
+
+def _override_dict_list(last_filenames: Any, new_filename: str) -> Any:
+    if len(last_filenames) != 1:
+        raise PipelineError(
+            "last operation created a dict of lists with one "
+            "list, but the list contains a number of filenames "
+            "different than one"
+        )
+
+    last_filenames[0] = new_filename
+    return last_filenames
+
+
+_OVERRIDE_DICT_HANDLERS: Dict[type, Callable[[Any, str], Any]] = {
+    str: _override_str,
+    list: _override_dict_list,
+}
+
+
+def _override_dict(last_filenames: Any, new_filename: str) -> Any:
+    if len(last_filenames) != 1:
+        raise PipelineError(
+            "last operation created a dict using more than one organism"
+        )
+
+    organism, organism_filenames = next(iter(last_filenames.items()))
+    handler = _OVERRIDE_DICT_HANDLERS.get(type(organism_filenames))
+    if handler is None:
+        raise PipelineError("last operation created an invalid dict")
+
+    last_filenames[organism] = handler(organism_filenames, new_filename)
+    return last_filenames
+
+
+_OVERRIDE_HANDLERS: Dict[type, Callable[[Any, str], Any]] = {
+    str: _override_str,
+    list: _override_list,
+    dict: _override_dict,
+}
+
+
 class Executor:
     """The class responsible for executing tasks.
 
@@ -153,112 +377,165 @@ class Executor:
     desired parameters. For more information, see the `__call__` method.
     """
 
-    RE_REPLACER = re.compile(r"\{([^}]+)\}")
-
     def __init__(self, analysis: Analysis) -> None:
         """Create a new instance."""
         self.analysis = analysis
         self.data: Optional[_ExecutorData] = None
+        self._log_fakes = False
+        self._additional_params: Dict[Optional[str], Dict[str, str]] = {}
+        self._organism_envs: Dict[Tuple[Hashable, ...], Dict[str, Any]] = {}
+        self._commands: List[Union[_Template, Callable[..., None]]] = []
+        self._output_formats: List[Union[_Template, Callable[..., str]]] = []
+        self._organism_filter: Callable[[Optional[str]], bool] = _is_any_organism
+
+    @staticmethod
+    def _evaluate(
+        expression: str, code: Optional[CodeType], env: Mapping[str, Any]
+    ) -> Any:
+        """Evaluate an expression using `env` as local variables.
+
+        Plain variable names are looked up directly in `env`, otherwise
+        the precompiled `code` of the expression is evaluated. A
+        `PipelineError` is raised if the evaluation fails or if it
+        returns `None`.
+        """
+        if expression in env:
+            evaluated = env[expression]
+        else:
+            if code is None:
+                raise PipelineError("cannot evaluate %s" % expression)
+
+            try:
+                evaluated = eval(code, globals(), env)
+            except Exception:
+                raise PipelineError("cannot evaluate %s" % expression)
+
+        if evaluated is None:
+            raise PipelineError("evaluation of %s is None" % expression)
+        return evaluated
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _get_template(s: str) -> _Template:
+        """Get the parsed template for `s`.
+
+        The most recently used templates are kept, because the strings
+        obtained from the callable output formats and the error strings
+        can be different for every file.
+        """
+        return _Template(s)
+
+    def _format(self, s: str, env: Mapping[str, Any]) -> str:
+        """Replace the evaluable arguments of `s` using `env`."""
+        return Executor._get_template(s).format(env)
+
+    def _compile(self) -> None:
+        """Prepare the commands and the output formats of the task.
+
+        The templates of the string commands and output formats are
+        obtained once for each call, instead of once for each analysis.
+        The output path is also joined in advance to the string output
+        formats.
+        """
+        assert self.data
+
+        command = self.data.command
+        raw_commands: List[Union[str, Callable[..., None]]]
+        if isinstance(command, list):
+            raw_commands = command
+        else:
+            raw_commands = [command]
+
+        self._commands = [
+            Executor._get_template(raw_command)
+            if isinstance(raw_command, str)
+            else raw_command
+            for raw_command in raw_commands
+        ]
+
+        output_format = self.data.output_format
+        output_path = self.data.output_path
+        raw_output_formats: List[Union[str, Callable[..., str]]]
+        if output_format is None:
+            raw_output_formats = []
+        elif isinstance(output_format, list):
+            raw_output_formats = output_format
+        else:
+            raw_output_formats = [output_format]
+
+        self._output_formats = []
+        for raw_output_format in raw_output_formats:
+            if isinstance(raw_output_format, str):
+                if output_path is not None:
+                    raw_output_format = os.path.join(output_path, raw_output_format)
+                self._output_formats.append(Executor._get_template(raw_output_format))
+            else:
+                self._output_formats.append(raw_output_format)
 
     def _handle_output_filename(
         self,
-        command_index: int,
-        commands_len: int,
         organism: str,
         output_filename: Union[List[str], str],
-        output_filenames: Dict[str, List[str]],
-        output_bamfiles: Dict[str, List[str]],
+        output_filenames: DefaultDict[str, List[str]],
+        output_bamfiles: DefaultDict[str, List[str]],
+        cwd: str,
     ) -> None:
         assert self.data
 
         if isinstance(output_filename, str):
             output_filename = [output_filename]
 
-        new_filename: List[str] = []
+        split_by_organism = self.data.split_by_organism
         for filename in output_filename:
-            dirname = os.path.dirname(filename)
-            if dirname == "" or dirname == ".":
-                new_filename.append(os.path.join(os.getcwd(), filename))
-            else:
-                new_filename.append(filename)
-        output_filename = new_filename
+            if os.sep not in filename or os.path.dirname(filename) == ".":
+                filename = os.path.join(cwd, filename)
 
-        if not self.data.save_only_last or command_index == commands_len - 1:
-            for filename in output_filename:
-                if self.data.split_by_organism:
-                    try:
-                        output_organism = BarcodedFilename(filename).organism
-                        if not output_organism:
-                            output_organism = organism
-                    except Exception:
-                        output_organism = organism
-                else:
-                    output_organism = organism
+            output_organism = organism
+            if split_by_organism:
+                barcode = _parse_barcode(filename)
+                if barcode is not None and barcode.organism:
+                    output_organism = barcode.organism
 
-                output_filenames.setdefault(output_organism, []).append(filename)
-                output_extension = os.path.splitext(filename)[1]
-                if output_extension == ".bam":
-                    output_bamfiles.setdefault(output_organism, []).append(filename)
+            output_filenames[output_organism].append(filename)
+            if filename.endswith(".bam"):
+                output_bamfiles[output_organism].append(filename)
 
     def _get_output_filename(
-        self, all_params: Mapping[str, Any]
+        self, env: Mapping[str, Any]
     ) -> Union[List[str], str, None]:
         assert self.data
 
-        locals().update(all_params)
-        if self.data.output_format is not None:
-
-            if isinstance(self.data.output_format, list):
-                raw_output_formats = self.data.output_format[:]
-            else:
-                raw_output_formats = [self.data.output_format]
+        output_function = self.data.output_function
 
-            output_formats: List[str] = []
-            for raw_output_format in raw_output_formats:
-                if isinstance(raw_output_format, str):
-                    output_formats.append(raw_output_format)
+        if self.data.output_format is not None:
+            output_path = self.data.output_path
+            output_filename: List[str] = []
+            for output_format in self._output_formats:
+                if isinstance(output_format, _Template):
+                    filename = output_format.format(env)
                 else:
                     # output_format is a Callable[..., str]
-                    output_formats.append(raw_output_format(**all_params))
-
-            if self.data.output_path is not None:
-                output_formats = [
-                    os.path.join(self.data.output_path, output_format)
-                    for output_format in output_formats
-                ]
-
-            output_filename = []
-            for s in output_formats:
-                for match in Executor.RE_REPLACER.finditer(s):
-                    try:
-                        evaluated = eval(match.group(1))
-                    except Exception:
-                        raise PipelineError("cannot evaluate %s" % match.group(1))
+                    current_format = output_format(**env)
+                    if output_path is not None:
+                        current_format = os.path.join(output_path, current_format)
+                    filename = self._format(current_format, env)
 
-                    if evaluated is None:
-                        raise PipelineError("evaluation of %s is None" % match.group(1))
-                    s = re.sub(match.group(0), str(evaluated), s)
-
-                output_filename.append(s)
-
-            if self.data.output_function is not None:
-                output_filename = [
-                    filename
-                    for filenames in map(self.data.output_function, output_filename)
-                    for filename in filenames
-                ]
+                if output_function is None:
+                    output_filename.append(filename)
+                else:
+                    output_filename.extend(output_function(filename))
 
             if len(output_filename) == 1:
                 return output_filename[0]
             else:
                 return output_filename
 
-        elif self.data.output_function is not None:
-            input_filenames = all_params["input_filenames"]
+        elif output_function is not None:
+            input_filenames = env["input_filenames"]
             output_filenames = [
                 filename
                 for filenames in map(
-                    self.data.output_function,
+                    output_function,
                     [filename.filename for filename in input_filenames],
                 )
                 for filename in filenames
@@ -289,32 +566,32 @@ class Executor:
 
             for file_data in input_filename:
                 filename = file_data.filename
-                extension = os.path.splitext(filename)[1].lower()
                 os.unlink(filename)
-                if extension == ".bam":
-                    bai_file = filename[:-4] + ".bai"
-                    if os.path.exists(bai_file):
-                        os.unlink(bai_file)
+                if filename.lower().endswith(".bam"):
+                    try:
+                        os.unlink(filename[:-4] + ".bai")
+                    except FileNotFoundError:
+                        pass
 
     def _handle_command(
         self,
         current_command: Union[str, Callable[..., None]],
-        all_params: Mapping[str, Any],
+        env: Mapping[str, Any],
     ) -> None:
         assert self.data
 
-        locals().update(all_params)
+        if self.analysis.run_fake:
+            if self._log_fakes:
+                if isinstance(current_command, str):
+                    self.analysis.logger.info("Faking command '%s'", current_command)
+                else:
+                    self.analysis.logger.info("Faking lambda")
+            return
+
         if isinstance(current_command, str):
-            if not self.analysis.run_fake:
-                status = utils.run_and_log(current_command, self.analysis.logger)
-            else:
-                self.analysis.logger.info("Faking command '%s'", current_command)
-                status = 0
+            status = utils.run_and_log(current_command, self.analysis.logger)
         else:
-            if not self.analysis.run_fake:
-                current_command(**all_params)
-            else:
-                self.analysis.logger.info("Faking lambda")
+            current_command(**env)
             status = 0
 
         if status != 0:
@@ -331,25 +608,9 @@ class Executor:
             else:
                 exception_string = self.data.exception_string
 
-            for match in Executor.RE_REPLACER.finditer(error_string):
-                try:
-                    error_string = re.sub(
-                        match.group(0), str(eval(match.group(1))), error_string
-                    )
-                except Exception:
-                    raise PipelineError(
-                        "cannot replace parameter %s" % (match.group(0))
-                    )
-
-            for match in Executor.RE_REPLACER.finditer(exception_string):
-                try:
-                    exception_string = re.sub(
-                        match.group(0), str(eval(match.group(1))), exception_string
-                    )
-                except Exception:
-                    raise PipelineError(
-                        "cannot replace parameter %s" % (match.group(0))
-                    )
+            error_params = dict(env, status=status)
+            error_string = self._format(error_string, error_params)
+            exception_string = self._format(exception_string, error_params)
             self.analysis.logger.error(error_string)
             raise PipelineError(exception_string)
 
@@ -363,29 +624,24 @@ class Executor:
 
         mod_input_filenames: AnalysesPerOrganism = {}
         for organism, analyses in input_filenames.items():
-            mod_analyses = mod_input_filenames.setdefault(organism, [])
+            mod_analyses: List[SingleAnalysis] = []
+            mod_input_filenames[organism] = mod_analyses
 
             for analysis in analyses:
-                filenames = [analysis_file.filename for analysis_file in analysis]
-
                 if self.data.input_split_reads:
-                    splitted_data: Dict[int, List[str]] = {}
-                    for filename in filenames:
-                        try:
-                            barcoded = BarcodedFilename(filename)
-                            if barcoded.read_index:
-                                splitted_data.setdefault(
-                                    barcoded.read_index, []
-                                ).append(filename)
-                            else:
-                                splitted_data.setdefault(0, []).append(filename)
-                        except Exception:
-                            splitted_data.setdefault(0, []).append(filename)
+                    splitted_data: DefaultDict[int, List[str]] = defaultdict(list)
+                    for analysis_file in analysis:
+                        barcoded = getattr(analysis_file, "barcode", None)
+                        if barcoded is not None and barcoded.read_index:
+                            read_index = barcoded.read_index
+                        else:
+                            read_index = 0
+                        splitted_data[read_index].append(analysis_file.filename)
 
                     for filenames in splitted_data.values():
-                        param: Union[str, List[str]] = list(filenames)
-                        if len(param) == 1:
-                            param = param[0]
+                        param: Union[str, List[str]] = filenames
+                        if len(filenames) == 1:
+                            param = filenames[0]
 
                         input_str = self.data.input_function(param)
                         if input_str:
@@ -393,15 +649,18 @@ class Executor:
                                 SingleAnalysis([AnalysisFileData(input_str)])
                             )
                 else:
+                    filenames = [analysis_file.filename for analysis_file in analysis]
                     result = cast(Callable[[List[str]], str], self.data.input_function)(
                         filenames
                     )
                     mod_analyses.append(SingleAnalysis([AnalysisFileData(result)]))
 
+        # When reads are not split, each organism already has one single
+        # analysis with one file, therefore the result does not need to
+        # be fixed again.
         if not mod_input_filenames:
             raise PipelineError("empty input list")
 
-        self._fix_input_filenames(mod_input_filenames)
         return mod_input_filenames
 
     def _fix_input_filenames(self, input_filenames: AnalysesPerOrganism) -> None:
@@ -423,6 +682,16 @@ class Executor:
         analyses: List[SingleAnalysis]
     ) -> List[SingleAnalysis]:
 
+        controls_by_key: Dict[
+            Tuple[Hashable, ...], List[Tuple[SingleAnalysis, AnalysisFileData]]
+        ] = {}
+        for analysis in analyses:
+            for file_data in analysis:
+                if file_data.type == AnalysisType.Control:
+                    controls_by_key.setdefault(
+                        file_data.barcode.key_without_tissue(), []
+                    ).append((analysis, file_data))
+
         for analysis_index, analysis in enumerate(analyses):
             if not analysis:
                 continue
@@ -431,27 +700,23 @@ class Executor:
             if file_data.type != AnalysisType.Sample:
                 continue
 
-            controls = [
-                (other_analysis, other_file_data)
-                for other_analysis in analyses
-                for other_file_data in other_analysis
-                if file_data.barcode.equals_without_tissue(other_file_data.barcode)
-                and other_file_data.barcode.tissue.is_normal()
-            ]
+            available_controls = controls_by_key.get(
+                file_data.barcode.key_without_tissue(), []
+            )
 
-            if len(controls) == 1:
-                control = controls[0]
+            if len(available_controls) == 1:
+                control = available_controls.pop()
                 analysis.append(control[1])
                 control[0].remove(control[1])
             else:
-                sequencing_specific = [
+                controls = [
                     control
-                    for control in controls
+                    for control in available_controls
                     if control[1].barcode.sequencing == file_data.barcode.sequencing
                 ]
 
-                if sequencing_specific:
-                    controls = sequencing_specific
+                if not controls:
+                    controls = available_controls[:]
 
                 analyses[analysis_index] = SingleAnalysis(
                     analysis + [control[1] for control in controls]
@@ -459,6 +724,7 @@ class Executor:
 
                 for control in controls:
                     control[0].remove(control[1])
+                    available_controls.remove(control)
 
         return [analysis for analysis in analyses if analysis]
 
@@ -517,11 +783,21 @@ class Executor:
             return (input_filenames, {})
 
     def _get_additional_params(self, organism: Optional[str]) -> Dict[str, str]:
+        try:
+            return self._additional_params[organism]
+        except KeyError:
+            pass
+
+        additional_params = self._create_additional_params(organism)
+        self._additional_params[organism] = additional_params
+        return additional_params
+
+    def _create_additional_params(self, organism: Optional[str]) -> Dict[str, str]:
         additional_params = {}
 
         if not organism:
             additional_params["organism_str"] = ""
-            organism = utils.get_human_annotation(self.analysis.config)
+            organism = self.analysis.human_annotation
         else:
             additional_params["organism_str"] = "." + organism
 
@@ -550,12 +826,48 @@ class Executor:
 
         return additional_params
 
+    def _get_organism_env(self, barcode: Optional[BarcodedFilename]) -> Dict[str, Any]:
+        """Get the evaluable arguments shared by the files of an organism.
+
+        The config, the kit and the organism dependent parameters are
+        the same for all the files with the same organism, kit and
+        analyte, therefore they are obtained once for each combination
+        and reused as the base environment of each analysis.
+        """
+        key: Tuple[Hashable, ...]
+        if barcode is None:
+            key = (None, None, None)
+        else:
+            key = (barcode.organism, barcode.kit, barcode.analyte)
+
+        try:
+            return self._organism_envs[key]
+        except KeyError:
+            pass
+
+        organism: Optional[str]
+        kit: Optional[KitData]
+        if barcode is None:
+            organism = None
+            kit = None
+        else:
+            organism = barcode.organism
+            kit = utils.get_kit_from_barcoded(self.analysis.config, barcode)
+
+        env: Dict[str, Any] = {"config": self.analysis.config, "kit": kit}
+        env.update(self._get_kit_additional_params(organism, kit))
+        env.update(self._get_additional_params(organism))
+        env["organism"] = organism if organism else self.analysis.human_annotation
+
+        self._organism_envs[key] = env
+        return env
+
     def _get_kit_additional_params(
         self, organism: Optional[str], kit: Optional[KitData]
     ) -> Dict[str, str]:
         additional_params = {}
         if not organism:
-            organism = utils.get_human_annotation(self.analysis.config)
+            organism = self.analysis.human_annotation
 
         if kit and organism.startswith("hg"):
             additional_params["indels"] = getattr(kit, "indels_{}".format(organism))
@@ -563,67 +875,51 @@ class Executor:
         return additional_params
 
     def _get_commands(
-        self, all_params: Mapping[str, Any]
+        self, env: Mapping[str, Any]
     ) -> List[Union[str, Callable[..., None]]]:
-        assert self.data
-        assert self.data.command
-
-        locals().update(all_params)
-
-        commands: List[Union[str, Callable[..., None]]] = []
-        if isinstance(self.data.command, list):
-            for s in self.data.command:
-                if isinstance(s, str):
-                    for match in Executor.RE_REPLACER.finditer(s):
-                        try:
-                            evaluated = eval(match.group(1))
-                        except Exception:
-                            raise PipelineError("cannot evaluate %s" % match.group(1))
-
-                        if evaluated is None:
-                            raise PipelineError(
-                                "evaluation of %s is None" % (match.group(1))
-                            )
-
-                        s = s.replace(match.group(0), str(evaluated))
+        return [
+            command.format(env) if isinstance(command, _Template) else command
+            for command in self._commands
+        ]
 
-                commands.append(s)
-        else:
-            if isinstance(self.data.command, str):
-                current_command = str(self.data.command)
-                for match in Executor.RE_REPLACER.finditer(self.data.command):
-                    try:
-                        evaluated = eval(match.group(1))
-                    except Exception:
-                        raise PipelineError("cannot evaluate %s" % (match.group(1)))
-
-                    if evaluated is None:
-                        raise PipelineError(
-                            "evaluation of %s is None" % (match.group(1))
-                        )
-
-                    current_command = current_command.replace(
-                        match.group(0), str(evaluated)
-                    )
+    def _iter_analysis_units(
+        self,
+        input_filenames: AnalysesPerOrganism,
+        mod_input_filenames: AnalysesPerOrganism,
+    ) -> Iterator[Tuple[SingleAnalysis, Optional[SingleAnalysis]]]:
+        """Iterate over the analyses of all the organisms.
+
+        Each unit is a pair of an analysis and the respective analysis
+        obtained through the `input_function`, or `None` if the latter
+        has not been specified.
+        """
+        assert self.data
 
-                commands.append(current_command)
+        input_function = self.data.input_function
+        for organism, analyses in input_filenames.items():
+            if input_function is not None:
+                mod_analyses = mod_input_filenames[organism]
+                if len(mod_analyses) == len(analyses):
+                    yield from zip(analyses, mod_analyses)
+                else:
+                    yield from zip(mod_analyses, mod_analyses)
             else:
-                commands.append(self.data.command)
-
-        return commands
+                yield from zip(analyses, itertools.repeat(None))
 
     def _handle_analysis(
         self,
         analysis_input: SingleAnalysis,
         mod_analysis_input: Optional[SingleAnalysis],
-        output_filenames: Dict[str, List[str]],
-        output_bamfiles: Dict[str, List[str]],
+        output_filenames: DefaultDict[str, List[str]],
+        output_bamfiles: DefaultDict[str, List[str]],
         analyses: AnalysesPerOrganism,
+        cwd: str,
     ) -> None:
-        assert self.data
+        data = self.data
+        assert data
 
         real_analysis_input: Optional[SingleAnalysis]
-        if self.data.input_function is not None:
+        if data.input_function is not None:
             assert mod_analysis_input
 
             real_analysis_input = analysis_input
@@ -631,59 +927,77 @@ class Executor:
         else:
             real_analysis_input = None
 
-        input_filenames = analysis_input
-        if len(analysis_input) == 1:
-            input_filename = analysis_input[0]
-
         file_data = analysis_input.sample
         if not file_data:
             file_data = analysis_input.control
 
-        if not self.data.allow_raw_filenames:
+        if not data.allow_raw_filenames:
             assert file_data
 
-        if file_data:
-            organism = file_data.barcode.organism
-            kit = utils.get_kit_from_barcoded(self.analysis.config, file_data.barcode)
-        else:
-            organism = None
-            kit = None
-
-        locals().update(self._get_kit_additional_params(organism, kit))
-
-        if not self.data.only_human or not organism or organism.startswith("hg"):
-            locals().update(self._get_additional_params(organism))
-            if not organism:
-                organism = utils.get_human_annotation(self.analysis.config)
-
-            local_params = {
-                key: value for key, value in locals().items() if key != "self"
-            }
-            output_filename = self._get_output_filename(local_params)
-
-            local_params.update(
-                {"output_filename": output_filename, "config": self.analysis.config}
-            )
-            commands = self._get_commands(local_params)
-
+        barcode = file_data.barcode if file_data else None
+        organism = barcode.organism if barcode else None
+
+        if self._organism_filter(organism):
+            organism_env = self._get_organism_env(barcode)
+            organism = organism_env["organism"]
+            env = dict(organism_env)
+            env["input_filenames"] = analysis_input
+            env["real_analysis_input"] = real_analysis_input
+            if len(analysis_input) == 1:
+                env["input_filename"] = analysis_input[0]
+
+            output_filename = self._get_output_filename(env)
+            env["output_filename"] = output_filename
+            commands = self._get_commands(env)
+
+            # With save_only_last, the output filenames are only handled
+            # after the last command.
+            first_saving_index = len(commands) - 1 if data.save_only_last else 0
             for command_index, current_command in enumerate(commands):
-                self._handle_command(
-                    current_command,
-                    {key: value for key, value in locals().items() if key != "self"},
-                )
+                self._handle_command(current_command, env)
 
-                if output_filename:
+                if output_filename and command_index >= first_saving_index:
                     self._handle_output_filename(
-                        command_index,
-                        len(commands),
                         organism,
                         output_filename,
                         output_filenames,
                         output_bamfiles,
+                        cwd,
                     )
 
         self._unlink_filename(analysis_input, real_analysis_input)
 
+    def _handle_analyses_concurrently(
+        self,
+        units: Iterable[Tuple[SingleAnalysis, Optional[SingleAnalysis]]],
+        jobs: int,
+        output_filenames: DefaultDict[str, List[str]],
+        output_bamfiles: DefaultDict[str, List[str]],
+        analyses: AnalysesPerOrganism,
+        cwd: str,
+    ) -> None:
+        def handle_unit(
+            unit: Tuple[SingleAnalysis, Optional[SingleAnalysis]]
+        ) -> Tuple[DefaultDict[str, List[str]], DefaultDict[str, List[str]]]:
+            unit_filenames: DefaultDict[str, List[str]] = defaultdict(list)
+            unit_bamfiles: DefaultDict[str, List[str]] = defaultdict(list)
+            self._handle_analysis(
+                unit[0], unit[1], unit_filenames, unit_bamfiles, analyses, cwd
+            )
+            return unit_filenames, unit_bamfiles
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(handle_unit, unit) for unit in units]
+
+            # Results are merged in submission order, in order to obtain
+            # the same output filenames of a sequential execution.
+            for future in futures:
+                unit_filenames, unit_bamfiles = future.result()
+                for organism, filenames in unit_filenames.items():
+                    output_filenames[organism].extend(filenames)
+                for organism, filenames in unit_bamfiles.items():
+                    output_bamfiles[organism].extend(filenames)
+
     def __call__(
         self,
         command: Union[str, List[str], Callable[..., None]],
@@ -909,46 +1223,48 @@ class Executor:
             split_input_files,
             allow_raw_filenames,
         )
+        self._compile()
+        if only_human:
+            self._organism_filter = _is_human_organism
+        else:
+            self._organism_filter = _is_any_organism
 
         _input_filenames, mod_input_filenames = self._get_input_filenames()
-
-        output_filenames: Dict[str, List[str]] = {}
-        output_bamfiles: Dict[str, List[str]] = {}
-        for current_organism in _input_filenames.keys():
-            current_input_filenames = _input_filenames[current_organism]
-
-            iterator: Union[
-                Iterable[Tuple[SingleAnalysis, SingleAnalysis]],
-                Iterable[Tuple[SingleAnalysis, None]],
-            ]
-            if input_function is not None:
-                current_mod_input_filenames = mod_input_filenames[current_organism]
-                if len(current_mod_input_filenames) == len(current_input_filenames):
-                    iterator = zip(current_input_filenames, current_mod_input_filenames)
-                else:
-                    iterator = zip(
-                        current_mod_input_filenames, current_mod_input_filenames
-                    )
-            else:
-                iterator = zip(
-                    current_input_filenames, [None] * len(current_input_filenames)
-                )
-
-            for input_filename, mod_input_filename in iterator:
+        cwd = os.getcwd()
+        self._log_fakes = self.analysis.logger.isEnabledFor(logging.INFO)
+
+        units = self._iter_analysis_units(_input_filenames, mod_input_filenames)
+
+        output_filenames: DefaultDict[str, List[str]] = defaultdict(list)
+        output_bamfiles: DefaultDict[str, List[str]] = defaultdict(list)
+        # Analysis units are run on threads rather than processes: the
+        # samples are already handled by a pool of daemonic processes,
+        # which cannot have children, and the commands spend their time
+        # in subprocesses that do not hold the GIL. Faked commands do
+        # not run anything, therefore they are never worth a pool. The
+        # threads of the pool are only started when units are submitted.
+        jobs = self.analysis.config.executor_jobs
+        if jobs > 1 and not self.analysis.run_fake:
+            self._handle_analyses_concurrently(
+                units, jobs, output_filenames, output_bamfiles, _input_filenames, cwd
+            )
+        else:
+            for input_filename, mod_input_filename in units:
                 self._handle_analysis(
                     input_filename,
                     mod_input_filename,
                     output_filenames,
                     output_bamfiles,
                     _input_filenames,
+                    cwd,
                 )
 
         if override_last_files:
-            self.analysis.last_operation_filenames = output_filenames
+            self.analysis.last_operation_filenames = dict(output_filenames)
             self.analysis.can_unlink = True
 
         if write_bam_files and len(output_bamfiles) != 0:
-            self.analysis.bamfiles = output_bamfiles
+            self.analysis.bamfiles = dict(output_bamfiles)
 
     def override_last_operation_filename(self, new_filename: str) -> None:
         """Override the last operation filenames. DEPRECATED.
@@ -962,36 +1278,9 @@ class Executor:
         if not self.analysis.last_operation_filenames:
             raise PipelineError("last operation did not leave an output file")
 
-        if isinstance(self.analysis.last_operation_filenames, str):
-            self.analysis.last_operation_filenames = new_filename
-        elif isinstance(self.analysis.last_operation_filenames, list):
-            if len(self.analysis.last_operation_filenames) != 1:
-                raise PipelineError(
-                    "last operation created a list with a number of output "
-                    "files different than one"
-                )
-
-            self.analysis.last_operation_filenames[0] = new_filename
-        elif isinstance(self.analysis.last_operation_filenames, dict):
-            if len(self.analysis.last_operation_filenames) != 1:
-                raise PipelineError(
-                    "last operation created a dict using more than one organism"
-                )
-
-            organism, last_filenames = next(
-                iter(self.analysis.last_operation_filenames.items())
-            )
-            if isinstance(last_filenames, str):
-                self.analysis.last_operation_filenames[organism] = new_filename
-            elif isinstance(last_filenames, list):
-                if len(last_filenames) != 1:
-                    raise PipelineError(
-                        "last operation created a dict of lists with one "
-                        "list, but the list contains a number of filenames "
-                        "different than one"
-                    )
-                self.analysis.last_operation_filenames[organism][0] = new_filename
-            else:
-                raise PipelineError("last operation created an invalid dict")
-        else:
+        last_filenames = self.analysis.last_operation_filenames
+        handler = _OVERRIDE_HANDLERS.get(type(last_filenames))
+        if handler is None:
             raise PipelineError("last operation created an invalid object")
+
+        self.analysis.last_operation_filenames = handler(last_filenames, new_filename)
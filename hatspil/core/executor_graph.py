@@ -0,0 +1,128 @@
+"""A module to run the steps of an analysis as a dependency graph.
+
+Most of the steps of an analysis depend on the output of the previous
+one, but some of them only need to wait for a subset of the other
+steps. This module contains the `ExecutorGraph` class, which allows to
+describe the dependencies between the steps and to run the independent
+ones concurrently.
+"""
+
+import heapq
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from .exceptions import PipelineError
+
+
+class ExecutorGraph:
+    """A directed acyclic graph of analysis steps.
+
+    Each node of the graph is a step, a python function without
+    arguments that generally uses one or more `Executor` calls. A step
+    can be added only after all the steps it depends on, therefore the
+    graph cannot contain cycles and the insertion order is always a
+    valid sequential order.
+
+    When the graph is run with more than one job, the ready steps are
+    started concurrently, giving precedence to the ones with the
+    highest number of descendants, in order to expose as much
+    parallelism as possible in the early stages. Steps that run
+    concurrently must not change `analysis.last_operation_filenames`
+    of the same `Analysis` instance, therefore they should use the
+    `override_last_files=False` parameter of `Executor`.
+    """
+
+    def __init__(self, jobs: int = 1) -> None:
+        """Create an empty graph.
+
+        Args:
+            jobs: the maximum number of steps that can run concurrently.
+                  With one job, the steps are run sequentially in the
+                  same order they have been added.
+        """
+        self.jobs = jobs
+        self._steps: Dict[str, Callable[[], None]] = {}
+        self._dependencies: Dict[str, Set[str]] = {}
+        self._dependents: Dict[str, List[str]] = {}
+
+    def add(
+        self, name: str, step: Callable[[], None], after: Iterable[str] = ()
+    ) -> None:
+        """Add a step to the graph.
+
+        Args:
+            name: the unique name of the step.
+            step: the function to call.
+            after: the names of the steps that must be completed before
+                   running this one. They must have already been added.
+        """
+        if name in self._steps:
+            raise PipelineError("step %s already in graph" % name)
+
+        dependencies = set(after)
+        for dependency in dependencies:
+            if dependency not in self._steps:
+                raise PipelineError(
+                    "step %s depends on unknown step %s" % (name, dependency)
+                )
+            self._dependents[dependency].append(name)
+
+        self._steps[name] = step
+        self._dependencies[name] = dependencies
+        self._dependents[name] = []
+
+    def _get_descendants_count(self) -> Dict[str, int]:
+        descendants: Dict[str, Set[str]] = {}
+        for name in reversed(list(self._steps)):
+            current_descendants: Set[str] = set()
+            for dependent in self._dependents[name]:
+                current_descendants.add(dependent)
+                current_descendants.update(descendants[dependent])
+            descendants[name] = current_descendants
+
+        return {name: len(names) for name, names in descendants.items()}
+
+    def run(self) -> None:
+        """Run all the steps, respecting the dependencies.
+
+        If a step raises an exception, no other step is started and the
+        exception is propagated once the running steps are completed.
+        """
+        if self.jobs <= 1:
+            for step in self._steps.values():
+                step()
+            return
+
+        descendants_count = self._get_descendants_count()
+        order = {name: index for index, name in enumerate(self._steps)}
+        missing = {name: set(deps) for name, deps in self._dependencies.items()}
+
+        ready: List[Tuple[int, int, str]] = []
+
+        def push(name: str) -> None:
+            heapq.heappush(ready, (-descendants_count[name], order[name], name))
+
+        for name, dependencies in missing.items():
+            if not dependencies:
+                push(name)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running: Dict[Future, str] = {}
+            while ready or running:
+                while ready and len(running) < self.jobs:
+                    name = heapq.heappop(ready)[2]
+                    running[pool.submit(self._steps[name])] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        wait(running)
+                        raise exception
+
+                    for dependent in self._dependents[name]:
+                        missing[dependent].discard(name)
+                        if not missing[dependent]:
+                            push(dependent)
@@ -32,7 +32,7 @@ class Starter:
             analysis: the instance of an `Analysis` class.
             directory: the directory where to search for FASTQ files.
         """
-        human_annotation = utils.get_human_annotation(analysis.config)
+        human_annotation = analysis.human_annotation
         input_filenames = [
             os.path.join(directory, filename)
             for pair in utils.find_fastqs_by_organism(
@@ -1,18 +1,20 @@
 """A collection of utility function, shared across modules."""
 import collections
 import datetime
+import functools
 import gzip as gz
 import logging
 import os
 import re
 import shutil
 import subprocess
+import tempfile
 from argparse import ArgumentTypeError
 from copy import deepcopy
 from logging import Logger
-from typing import (Any, Callable, Dict, Generator, Iterable, List, Mapping,
-                    Optional, Sequence, Tuple, TypeVar, Union, ValuesView,
-                    cast)
+from typing import (IO, Any, BinaryIO, Callable, Dict, Generator, Iterable,
+                    List, Mapping, Optional, Sequence, Tuple, TypeVar, Union,
+                    ValuesView, cast)
 
 from ..config import Config, KitData
 from .barcoded_filename import BarcodedFilename
@@ -75,6 +77,98 @@ def run_and_log(command: str, logger: Logger) -> int:
         return process.wait()
 
 
+def run_and_log_piped(
+    command: str, logger: Logger, writer: Callable[[BinaryIO], None]
+) -> int:
+    """Run a command feeding its standard input, and log everything.
+
+    The command is run using `subprocess.Popen` and `writer` is called
+    with the standard input of the process, which is closed afterwards.
+    The standard output and the standard error are collected in
+    temporary files, in order to avoid dead locks while writing, and
+    they are piped into the logger when the process exits.
+
+    Args:
+        command: the command to run.
+        logger: the logger.
+        writer: the function writing the input of the command.
+
+    Returns:
+        int: the exit status of the process.
+
+    """
+    logger.info("Running command: %s", command)
+    with tempfile.TemporaryFile() as out_fd, tempfile.TemporaryFile() as err_fd:
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=out_fd, stderr=err_fd, shell=True
+        )
+        stdin = cast(BinaryIO, process.stdin)
+        try:
+            writer(stdin)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+        status = process.wait()
+        _log_file_lines(out_fd, logger.info)
+        _log_file_lines(err_fd, logger.warning)
+        return status
+
+
+def run_and_log_reading(
+    command: str, logger: Logger, reader: Callable[[BinaryIO], None]
+) -> int:
+    """Run a command consuming its standard output, and log everything.
+
+    The command is run using `subprocess.Popen` and `reader` is called
+    with the standard output of the process, which is closed afterwards.
+    The standard error is collected in a temporary file and it is piped
+    into the logger when the process exits.
+
+    Args:
+        command: the command to run.
+        logger: the logger.
+        reader: the function reading the output of the command.
+
+    Returns:
+        int: the exit status of the process.
+
+    """
+    logger.info("Running command: %s", command)
+    with tempfile.TemporaryFile() as err_fd:
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=err_fd, shell=True
+        )
+        stdout = cast(BinaryIO, process.stdout)
+        try:
+            reader(stdout)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            stdout.close()
+
+        status = process.wait()
+        _log_file_lines(err_fd, logger.warning)
+        return status
+
+
+def _log_file_lines(fd: IO[bytes], log: Callable[[str], None]) -> None:
+    fd.seek(0)
+    for line in fd.read().decode(errors="replace").split("\n"):
+        if line != "":
+            log(line)
+
+
 def get_sample_filenames(
     obj: Union[Sequence[str], Mapping[str, List[str]], str],
     split_by_organism: bool = False,
@@ -255,6 +349,47 @@ def get_picard_max_records_string(max_records: str) -> str:
         return " MAX_RECORDS_IN_RAM=%d" % int(max_records)
 
 
+def get_picard_deflater_string(use_jdk_deflater: bool) -> str:
+    """Get the deflater and inflater string for Picard.
+
+    Create the 'USE_JDK_DEFLATER' and 'USE_JDK_INFLATER' parameters
+    when `use_jdk_deflater` is set, otherwise an empty string is
+    returned and Picard uses its default (Intel) implementations.
+    """
+    if use_jdk_deflater:
+        return " USE_JDK_DEFLATER=true USE_JDK_INFLATER=true"
+    else:
+        return ""
+
+
+reSamtoolsVersion = re.compile(r"^samtools (\d+)\.(\d+)")
+
+
+@functools.lru_cache()
+def get_samtools_version(samtools: str) -> Optional[Tuple[int, int]]:
+    """Get the major and minor version of Samtools.
+
+    The version is parsed from the output of `samtools --version`.
+    `None` is returned if Samtools cannot be run or if the version
+    cannot be parsed.
+    """
+    try:
+        output = subprocess.run(
+            f"{samtools} --version",
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).stdout
+    except OSError:
+        return None
+
+    match = reSamtoolsVersion.match(output)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
 def find_fastqs_by_organism(
     sample: str, fastq_dir: str, default_organism: str
 ) -> Dict[str, List[Tuple[str, int]]]:
@@ -273,18 +408,15 @@ def find_fastqs_by_organism(
 
     """
     re_fastq_filename = re.compile(
-        r"^%s(?:\.((?:hg|mm)\d+))?\.R([12])\.fastq(?:\.gz)?$" % sample, re.I
+        r"^%s(?:\.((?:hg|mm)\d+))?\.R([12])\.fastq(?:\.gz)?$" % re.escape(sample),
+        re.I,
     )
-    fastq_files = [
-        filename
-        for filename in os.listdir(fastq_dir)
-        if re_fastq_filename.match(filename)
-    ]
 
     fastqs: Dict[str, List[Tuple[str, int]]] = {}
-    for filename in fastq_files:
+    for filename in os.listdir(fastq_dir):
         match = re_fastq_filename.match(filename)
-        assert match is not None
+        if match is None:
+            continue
 
         organism = match.group(1)
         read_index = int(match.group(2))
@@ -1,10 +1,12 @@
 """The module for the abstraction of a MongoDB collection."""
-from typing import Any, Dict, List, Optional, cast
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, cast
 
 import hatspil.db
 
 try:
-    from pymongo import ReturnDocument
+    from pymongo import ReturnDocument, UpdateOne
+    from pymongo.collection import Collection as PymongoCollection
     from pymongo.cursor import Cursor
 except Exception:
     pass
@@ -19,6 +21,7 @@ class Collection:
     """
 
     db: Optional["hatspil.db.Db"]
+    _lock = threading.Lock()
 
     def __init__(self, db: "hatspil.db.Db", collection_name: str) -> None:
         """Create a new instance of the class.
@@ -28,12 +31,29 @@ class Collection:
             collection_name: the name of the collection in the database.
         """
         self.collection_name = collection_name
+        self._collection: Optional["PymongoCollection"] = None
         if db.config.use_mongodb:
             self.db = db
-            self.collection = db.db[collection_name]
         else:
             self.db = None
-            self.collection = None
+
+    @property
+    def collection(self) -> Optional["PymongoCollection"]:
+        """Get the underlying MongoDB collection.
+
+        The collection is obtained from the database the first time it
+        is needed, in order to avoid connecting to the MongoDB if the
+        collection is never used. `None` is returned if the MongoDB
+        cannot be used. The first access is guarded by a lock, because
+        the same instance can be used by concurrent steps.
+        """
+        if self._collection is None and self.db is not None:
+            with Collection._lock:
+                if self._collection is None:
+                    db = self.db.db
+                    if db is not None:
+                        self._collection = db[self.collection_name]
+        return self._collection
 
     def find_or_insert(
         self, data: Dict[Any, Any], new_data: Optional[Dict[Any, Any]] = None
@@ -71,6 +91,113 @@ class Collection:
         )
         return cast(Optional[Dict[str, Any]], retval)
 
+    def find_or_insert_many(
+        self,
+        data: Sequence[Optional[Dict[str, Any]]],
+        new_data: Optional[Sequence[Optional[Dict[str, Any]]]] = None,
+        projection: Optional[Sequence[str]] = None,
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Perform `Collection.find_or_insert` for many elements at once.
+
+        The unique elements of `data` are upserted with one bulk write.
+        The inserted elements are built from the data that has been
+        written, and only the ones already in the collection are
+        retrieved, with one query.
+
+        Args:
+            data: the things to match inside the collection for each
+                  element. An element can be `None` in order to skip
+                  it.
+            new_data: the data to set for each element, see
+                      `Collection.find_or_insert`.
+            projection: the fields to retrieve for the elements already
+                        in the collection, in addition to `_id` and the
+                        fields of `data`. If `None`, all the fields are
+                        retrieved.
+
+        Returns:
+            The content in the database for each element of `data`, or
+            `None` if the element is `None`. A list of `None` if the
+            MongoDB cannot be used.
+        """
+        if not self.db or not self.db.config.use_mongodb:
+            return [None] * len(data)
+
+        assert self.collection is not None
+
+        keys: List[Optional[Tuple[Hashable, ...]]] = []
+        unique_data: Dict[Tuple[Hashable, ...], Dict[str, Any]] = {}
+        unique_set_data: List[Dict[str, Any]] = []
+        operations = []
+        for index, current_data in enumerate(data):
+            if current_data is None:
+                keys.append(None)
+                continue
+
+            key = tuple(
+                sorted(
+                    (field, Collection._get_hashable(value))
+                    for field, value in current_data.items()
+                )
+            )
+            keys.append(key)
+            if key in unique_data:
+                continue
+
+            unique_data[key] = current_data
+            set_data = dict(current_data)
+            if new_data is not None and new_data[index] is not None:
+                set_data.update(cast(Dict[str, Any], new_data[index]))
+            unique_set_data.append(set_data)
+            operations.append(UpdateOne(current_data, {"$set": set_data}, upsert=True))
+
+        if not operations:
+            return [None] * len(data)
+
+        result = self.collection.bulk_write(operations, ordered=False)
+
+        documents: Dict[Tuple[Hashable, ...], Dict[str, Any]] = {}
+        unique_keys = list(unique_data)
+        for index, document_id in result.upserted_ids.items():
+            documents[unique_keys[index]] = {
+                "_id": document_id,
+                **unique_set_data[index],
+            }
+
+        existing_data = [
+            current_data
+            for key, current_data in unique_data.items()
+            if key not in documents
+        ]
+        if existing_data:
+            fields_sets = {tuple(field for field, _ in key) for key in unique_data}
+            fields_projection: Optional[List[str]] = None
+            if projection is not None:
+                fields_projection = sorted(set(projection).union(*fields_sets))
+
+            for document in self.collection.find(
+                {"$or": existing_data}, fields_projection
+            ):
+                for fields in fields_sets:
+                    document_key = tuple(
+                        (field, Collection._get_hashable(document.get(field)))
+                        for field in fields
+                    )
+                    if document_key in unique_data:
+                        documents.setdefault(document_key, document)
+
+        return [None if key is None else documents.get(key) for key in keys]
+
+    @staticmethod
+    def _get_hashable(value: Any) -> Hashable:
+        if isinstance(value, dict):
+            return tuple(
+                sorted(
+                    (key, Collection._get_hashable(item)) for key, item in value.items()
+                )
+            )
+        return cast(Hashable, value)
+
     def find(self, data: Dict[Any, Any]) -> Optional[Dict[str, Any]]:
         """Find an element in the collection.
 
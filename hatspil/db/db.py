@@ -7,14 +7,23 @@ More fine grained modules should be handled if possible (see `cutadapt`
 and `picard_metrics` modules), but at the same time the main class of
 this module, `Db`, can be used in powerful ways to perform simple tasks.
 """
-from typing import Any, Dict, Optional
+import os
+import threading
+import warnings
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
 
 from bson import ObjectId
 
 from ..config import Config
 from ..core.barcoded_filename import BarcodedFilename, Xenograft
+from ..core.exceptions import DataError
 from .collection import Collection
 
+try:
+    from pymongo.database import Database
+except Exception:
+    pass
+
 
 class Db:
     """The abstraction layer above the MongoDB for HaTSPiL.
@@ -36,6 +45,27 @@ class Db:
         "cutadapt",
         "picard_metrics",
     ]
+    _LAZY_COLLECTIONS = frozenset(_COLLECTIONS[5:])
+    _INDEXES = {
+        "projects": [["name"]],
+        "patients": [["project", "name"]],
+        "biopsies": [["patient", "index", "tissue"]],
+        "samples": [["biopsy", "index"], ["biopsy", "xenograft"]],
+        "sequencings": [["sample", "index"]],
+        "annotations": [["id", "assembly"]],
+    }
+    _databases: Dict[Tuple[Any, ...], "Database"] = {}
+    _databases_lock = threading.Lock()
+    __slots__ = (
+        "config",
+        "_db",
+        "_resolved",
+        "_stored",
+        "_projects",
+        "_patients",
+        *_COLLECTIONS,
+    )
+
     projects: Collection
     patients: Collection
     biopsies: Collection
@@ -51,24 +81,192 @@ class Db:
         """Create an instance of the class.
 
         If the configuration specifies that the MongoDB can be used, an
-        instance of the client is also created.
+        instance of the client is created when the database is accessed
+        for the first time (see `Db.db`).
 
         The collections are also populated automatically, creating an
-        instance of a `Collection` for each of them.
+        instance of a `Collection` for each of them. The collections
+        not involved in the barcode hierarchy are only created when
+        they are used for the first time.
+
+        The data retrieved for the barcodes are cached inside the
+        instance, therefore the same barcode is looked up in the
+        database only once (see `Db.invalidate`). For this reason, the
+        dicts returned by `Db.store_barcoded` and `Db.from_barcoded` must
+        not be modified.
         """
         self.config = config
+        self._resolved: Dict[Tuple[Hashable, ...], Dict[str, Dict[str, Any]]] = {}
+        self._stored: Dict[Tuple[Hashable, ...], Dict[str, Dict[str, Any]]] = {}
+        self._projects: Dict[str, Dict[str, Any]] = {}
+        self._patients: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+
+        self._db: Optional["Database"] = None
+
+        (
+            self.projects,
+            self.patients,
+            self.biopsies,
+            self.samples,
+            self.sequencings,
+        ) = [
+            Collection(self, collection_name)
+            for collection_name in Db._COLLECTIONS[:5]
+        ]
+
+    @property
+    def db(self) -> Optional["Database"]:
+        """Get the MongoDB database, connecting to it if necessary.
+
+        The client is created and authenticated only when the database
+        is needed for the first time, therefore creating a `Db` does not
+        perform any network operation. `None` is returned if the MongoDB
+        cannot be used.
+
+        The authenticated database, with its pool of connections, is
+        shared by all the instances of `Db` of the same process. The
+        connection is guarded by a lock, so that concurrent steps do not
+        create more than one client.
+        """
+        if self._db is None and self.config.use_mongodb:
+            config = self.config
+            database_key = (
+                os.getpid(),
+                config.mongodb_host,
+                config.mongodb_port,
+                config.mongodb_database,
+                config.mongodb_username,
+            )
+            db = Db._databases.get(database_key)
+            if db is None:
+                with Db._databases_lock:
+                    db = Db._databases.get(database_key)
+                    if db is None:
+                        db = self._connect()
+                        Db._databases[database_key] = db
+            self._db = db
+
+        return self._db
+
+    def _connect(self) -> "Database":
+        import bson
+        from pymongo import MongoClient
+
+        if not bson.has_c():
+            warnings.warn(
+                "the C extension of bson is not available, "
+                "MongoDB documents will be decoded slowly"
+            )
+
+        config = self.config
+        mongo = MongoClient(
+            config.mongodb_host, config.mongodb_port, connect=False, retryReads=True
+        )
+        db = mongo[config.mongodb_database]
+        db.authenticate(config.mongodb_username, config.mongodb_password)
+        Db._ensure_indexes(db)
+        return db
 
-        if config.use_mongodb:
-            from pymongo import MongoClient
+    @staticmethod
+    def _ensure_indexes(db: "Database") -> None:
+        """Create the indexes used to look up the barcode hierarchy.
+
+        The `_id` fields are always indexed by MongoDB, but the queries
+        performed by `Db.store_barcoded` and `Db.from_barcoded` filter
+        each level of the hierarchy by its parent and its own fields.
+        """
+        for collection_name, indexes in Db._INDEXES.items():
+            collection = db[collection_name]
+            for fields in indexes:
+                collection.create_index([(field, 1) for field in fields])
+
+    def __getattr__(self, name: str) -> Collection:
+        """Create the collections that are not used often on demand."""
+        if name not in Db._LAZY_COLLECTIONS:
+            raise AttributeError(
+                "'%s' object has no attribute '%s'" % (type(self).__name__, name)
+            )
+
+        collection = Collection(self, name)
+        setattr(self, name, collection)
+        return collection
 
-            mongo = MongoClient(config.mongodb_host, config.mongodb_port)
-            self.db = mongo[config.mongodb_database]
-            self.db.authenticate(config.mongodb_username, config.mongodb_password)
+    @staticmethod
+    def _get_barcode_key(barcoded: BarcodedFilename) -> Tuple[Hashable, ...]:
+        xenograft = barcoded.xenograft
+        return (
+            barcoded.project,
+            barcoded.patient,
+            int(barcoded.tissue),
+            barcoded.biopsy,
+            barcoded.sample,
+            None
+            if xenograft is None
+            else (xenograft.generation, xenograft.parent, xenograft.child),
+            barcoded.sequencing,
+            barcoded.molecule,
+            barcoded.analyte,
+        )
+
+    @staticmethod
+    def _get_query_chain(
+        barcoded: BarcodedFilename
+    ) -> Tuple[
+        Dict[str, Any],
+        Dict[str, Any],
+        Dict[str, Any],
+        Dict[str, Any],
+        Optional[Dict[str, Any]],
+    ]:
+        """Get the filters for each level of the hierarchy of a barcode.
+
+        The filters for the project, the patient, the biopsy, the sample
+        and the sequencing do not include the reference to the parent
+        level, which is only known once the parent has been found. The
+        filter for the sequencing is `None` when the barcode does not
+        specify the molecule or the analyte.
+        """
+        sequencing: Optional[Dict[str, Any]]
+        if barcoded.molecule is None or barcoded.analyte is None:
+            sequencing = None
         else:
-            self.db = None
+            sequencing = {
+                "index": barcoded.sequencing,
+                "molecule": int(barcoded.molecule),
+                "analyte": int(barcoded.analyte),
+            }
+
+        return (
+            {"name": barcoded.project},
+            {"name": barcoded.patient},
+            {"index": barcoded.biopsy, "tissue": int(barcoded.tissue)},
+            barcoded.get_sample_dict(),
+            sequencing,
+        )
 
-        for collection_name in Db._COLLECTIONS:
-            setattr(self, collection_name, Collection(self, collection_name))
+    def invalidate(self, barcoded: Optional[BarcodedFilename] = None) -> None:
+        """Drop the cached data for a barcode.
+
+        Needed when the database is changed without using this instance
+        of `Db`, in order to avoid using stale data.
+
+        Args:
+            barcoded: the barcode to forget. If `None`, all the cached
+                      data are dropped.
+        """
+        if barcoded is None:
+            self._resolved.clear()
+            self._stored.clear()
+            self._projects.clear()
+            self._patients.clear()
+            return
+
+        key = Db._get_barcode_key(barcoded)
+        self._resolved.pop(key, None)
+        self._stored.pop(key + (barcoded.kit,), None)
+        project = self._projects.pop(barcoded.project, None)
+        if project is not None:
+            self._patients.pop((project["_id"], barcoded.patient), None)
 
     def store_barcoded(self, barcoded: BarcodedFilename) -> Optional[Dict[str, Any]]:
         """Store a barcoded filename in the database.
@@ -85,58 +283,161 @@ class Db:
         if not self.config.use_mongodb:
             return None
 
-        project = self.projects.find_or_insert({"name": barcoded.project})
-        if not project:
-            return None
-
-        patient = self.patients.find_or_insert(
-            {"project": project["_id"], "name": barcoded.patient}
-        )
-        if not patient:
-            return None
+        key = Db._get_barcode_key(barcoded)
+        stored_key = key + (barcoded.kit,)
+        stored = self._stored.get(stored_key)
+        if stored is not None:
+            return stored
+
+        (
+            project_data,
+            patient_data,
+            biopsy_data,
+            sample_data,
+            sequencing_data,
+        ) = Db._get_query_chain(barcoded)
+
+        project = self._projects.get(barcoded.project)
+        if project is None:
+            project = self.projects.find_or_insert(project_data)
+            if not project:
+                return None
+            self._projects[barcoded.project] = project
+
+        patient_key = (project["_id"], barcoded.patient)
+        patient = self._patients.get(patient_key)
+        if patient is None:
+            patient = self.patients.find_or_insert(
+                {"project": project["_id"], **patient_data}
+            )
+            if not patient:
+                return None
+            self._patients[patient_key] = patient
 
         biopsy = self.biopsies.find_or_insert(
-            {
-                "patient": patient["_id"],
-                "index": barcoded.biopsy,
-                "tissue": int(barcoded.tissue),
-            }
+            {"patient": patient["_id"], **biopsy_data}
         )
         if biopsy is None:
             return None
 
-        sample_data = {"biopsy": biopsy["_id"]}
-        if barcoded.xenograft is None:
-            assert not barcoded.tissue.is_xenograft()
-            sample_data["index"] = barcoded.sample
-        else:
-            assert barcoded.tissue.is_xenograft()
-            sample_data["xenograft"] = barcoded.xenograft.to_dict()
-        sample = self.samples.find_or_insert(sample_data)
+        sample = self.samples.find_or_insert({"biopsy": biopsy["_id"], **sample_data})
         if sample is None:
             return None
 
-        if barcoded.molecule is None or barcoded.analyte is None:
+        if sequencing_data is None:
             return None
 
         sequencing = self.sequencings.find_or_insert(
-            {"sample": sample["_id"], "index": barcoded.sequencing},
-            {
-                "molecule": int(barcoded.molecule),
-                "analyte": int(barcoded.analyte),
-                "kit": barcoded.kit,
-            },
+            {"sample": sample["_id"], "index": sequencing_data["index"]},
+            {**sequencing_data, "kit": barcoded.kit},
         )
         if sequencing is None:
             return None
 
-        return {
+        stored = {
             "project": project,
             "patient": patient,
             "biopsy": biopsy,
             "sample": sample,
             "sequencing": sequencing,
         }
+        self._stored[stored_key] = stored
+        self._resolved[key] = stored
+        return stored
+
+    def store_barcoded_batch(
+        self, barcoded_list: Sequence[BarcodedFilename]
+    ) -> List[Optional[Dict[str, Dict[str, Any]]]]:
+        """Store many barcoded filenames in the database.
+
+        This is equivalent to calling `Db.store_barcoded` for each
+        barcode, but each level of the hierarchy is stored for all the
+        barcodes with one bulk write and then retrieved with one query.
+
+        The return value is a list with the value that `store_barcoded`
+        would return for each barcode.
+        """
+        if not self.config.use_mongodb:
+            return [None] * len(barcoded_list)
+
+        results = [
+            self._stored.get(Db._get_barcode_key(barcoded) + (barcoded.kit,))
+            for barcoded in barcoded_list
+        ]
+        missing = [
+            barcoded
+            for barcoded, result in zip(barcoded_list, results)
+            if result is None
+        ]
+        if not missing:
+            return results
+
+        chains = [Db._get_query_chain(barcoded) for barcoded in missing]
+
+        projects = self.projects.find_or_insert_many([chain[0] for chain in chains])
+        patients = self.patients.find_or_insert_many(
+            [
+                None if project is None else {"project": project["_id"], **chain[1]}
+                for chain, project in zip(chains, projects)
+            ],
+        )
+        biopsies = self.biopsies.find_or_insert_many(
+            [
+                None if patient is None else {"patient": patient["_id"], **chain[2]}
+                for chain, patient in zip(chains, patients)
+            ],
+        )
+        samples = self.samples.find_or_insert_many(
+            [
+                None if biopsy is None else {"biopsy": biopsy["_id"], **chain[3]}
+                for chain, biopsy in zip(chains, biopsies)
+            ],
+        )
+
+        sequencings_data: List[Optional[Dict[str, Any]]] = []
+        sequencings_new_data: List[Optional[Dict[str, Any]]] = []
+        for barcoded, chain, sample in zip(missing, chains, samples):
+            sequencing_data = chain[4]
+            if sample is None or sequencing_data is None:
+                sequencings_data.append(None)
+                sequencings_new_data.append(None)
+            else:
+                sequencings_data.append(
+                    {"sample": sample["_id"], "index": sequencing_data["index"]}
+                )
+                sequencings_new_data.append({**sequencing_data, "kit": barcoded.kit})
+        sequencings = self.sequencings.find_or_insert_many(
+            sequencings_data, sequencings_new_data
+        )
+
+        stored_iter = iter(
+            zip(missing, projects, patients, biopsies, samples, sequencings)
+        )
+        for index, result in enumerate(results):
+            if result is not None:
+                continue
+
+            barcoded, project, patient, biopsy, sample, sequencing = next(stored_iter)
+            if project is not None:
+                self._projects[barcoded.project] = project
+            if patient is not None:
+                self._patients[(patient["project"], barcoded.patient)] = patient
+            if sequencing is None:
+                continue
+
+            stored = {
+                "project": project,
+                "patient": patient,
+                "biopsy": biopsy,
+                "sample": sample,
+                "sequencing": sequencing,
+            }
+            key = Db._get_barcode_key(barcoded)
+            self._stored[key + (barcoded.kit,)] = stored
+            self._resolved[key] = stored
+            results[index] = stored
+
+        return results
 
     def from_barcoded(
         self, barcoded: BarcodedFilename
@@ -144,7 +445,10 @@ class Db:
         """Retrieve the data stored in the database for a barcode.
 
         Each part of the barcode is used to find the respective
-        representation in the database.
+        representation in the database. The whole hierarchy is
+        retrieved with a single aggregation; in case the server does
+        not support it, one query for each part of the barcode is
+        performed.
 
         The return value is a dict containing pairs of name of the part
         of the barcode and the content stored in the database.
@@ -155,48 +459,114 @@ class Db:
         if not self.config.use_mongodb:
             return None
 
-        project = self.projects.find({"name": barcoded.project})
-        if not project:
+        if barcoded.molecule is None or barcoded.analyte is None:
             return None
 
-        patient = self.patients.find(
-            {"project": project["_id"], "name": barcoded.patient}
+        key = Db._get_barcode_key(barcoded)
+        resolved = self._resolved.get(key)
+        if resolved is not None:
+            return resolved
+
+        from pymongo.errors import OperationFailure
+
+        try:
+            resolved = self._resolve_barcode_pipeline(barcoded)
+        except OperationFailure:
+            resolved = self._resolve_barcode_sequentially(barcoded)
+
+        if resolved is not None:
+            self._resolved[key] = resolved
+        return resolved
+
+    def _resolve_barcode_pipeline(
+        self, barcoded: BarcodedFilename
+    ) -> Optional[Dict[str, Dict[str, Any]]]:
+        assert self.projects.collection is not None
+
+        (
+            project_data,
+            patient_data,
+            biopsy_data,
+            sample_data,
+            sequencing_data,
+        ) = Db._get_query_chain(barcoded)
+        assert sequencing_data is not None
+
+        def lookup(
+            collection_name: str,
+            parent: Optional[str],
+            parent_field: str,
+            name: str,
+            data: Dict[str, Any],
+        ) -> List[Dict[str, Any]]:
+            parent_id = "$_id" if parent is None else f"${parent}._id"
+            match = dict(data)
+            match["$expr"] = {"$eq": [f"${parent_field}", "$$parent_id"]}
+            return [
+                {
+                    "$lookup": {
+                        "from": collection_name,
+                        "let": {"parent_id": parent_id},
+                        "pipeline": [{"$match": match}, {"$limit": 1}],
+                        "as": name,
+                    }
+                },
+                {"$unwind": f"${name}"},
+            ]
+
+        pipeline = [{"$match": project_data}, {"$limit": 1}]
+        pipeline += lookup("patients", None, "project", "patient", patient_data)
+        pipeline += lookup("biopsies", "patient", "patient", "biopsy", biopsy_data)
+        pipeline += lookup("samples", "biopsy", "biopsy", "sample", sample_data)
+        pipeline += lookup(
+            "sequencings", "sample", "sample", "sequencing", sequencing_data
         )
+
+        project = next(self.projects.collection.aggregate(pipeline), None)
+        if project is None:
+            return None
+
+        patient = project.pop("patient")
+        biopsy = project.pop("biopsy")
+        sample = project.pop("sample")
+        sequencing = project.pop("sequencing")
+        return {
+            "project": project,
+            "patient": patient,
+            "biopsy": biopsy,
+            "sample": sample,
+            "sequencing": sequencing,
+        }
+
+    def _resolve_barcode_sequentially(
+        self, barcoded: BarcodedFilename
+    ) -> Optional[Dict[str, Dict[str, Any]]]:
+        (
+            project_data,
+            patient_data,
+            biopsy_data,
+            sample_data,
+            sequencing_data,
+        ) = Db._get_query_chain(barcoded)
+        assert sequencing_data is not None
+
+        project = self.projects.find(project_data)
+        if not project:
+            return None
+
+        patient = self.patients.find({"project": project["_id"], **patient_data})
         if not patient:
             return None
 
-        biopsy = self.biopsies.find(
-            {
-                "patient": patient["_id"],
-                "index": barcoded.biopsy,
-                "tissue": int(barcoded.tissue),
-            }
-        )
+        biopsy = self.biopsies.find({"patient": patient["_id"], **biopsy_data})
         if biopsy is None:
             return None
 
-        sample_data = {"biopsy": biopsy["_id"]}
-        if barcoded.xenograft is None:
-            assert not barcoded.tissue.is_xenograft()
-            sample_data["index"] = barcoded.sample
-        else:
-            assert barcoded.tissue.is_xenograft()
-            sample_data["xenograft"] = barcoded.xenograft.to_dict()
-        sample = self.samples.find(sample_data)
+        sample = self.samples.find({"biopsy": biopsy["_id"], **sample_data})
         if sample is None:
             return None
 
-        if barcoded.molecule is None or barcoded.analyte is None:
-            return None
-
-        sequencing = self.sequencings.find(
-            {
-                "sample": sample["_id"],
-                "index": barcoded.sequencing,
-                "analyte": int(barcoded.analyte),
-                "molecule": int(barcoded.molecule),
-            }
-        )
+        sequencing = self.sequencings.find({"sample": sample["_id"], **sequencing_data})
         if sequencing is None:
             return None
 
@@ -214,11 +584,66 @@ class Db:
         """Retrieve the data stored in the database for a sequencing.
 
         This is similar to `Db.from_barcoded`, but only uses the id of
-        a sequencing to retrieve the data.
+        a sequencing to retrieve the data. The parents of the sequencing
+        are retrieved with a single aggregation, falling back to one
+        query for each of them if the server does not support it.
         """
         if not self.config.use_mongodb:
             return None
 
+        from pymongo.errors import OperationFailure
+
+        try:
+            return self._resolve_sequencing_pipeline(sequencing_id)
+        except OperationFailure:
+            return self._resolve_sequencing_sequentially(sequencing_id)
+
+    def _resolve_sequencing_pipeline(
+        self, sequencing_id: ObjectId
+    ) -> Optional[Dict[str, Dict[str, Any]]]:
+        assert self.sequencings.collection is not None
+
+        pipeline: List[Dict[str, Any]] = [
+            {"$match": {"_id": sequencing_id}},
+            {"$limit": 1},
+        ]
+        for collection_name, local_field, name in (
+            ("samples", "sample", "sample_data"),
+            ("biopsies", "sample_data.biopsy", "biopsy_data"),
+            ("patients", "biopsy_data.patient", "patient_data"),
+            ("projects", "patient_data.project", "project_data"),
+        ):
+            pipeline.append(
+                {
+                    "$lookup": {
+                        "from": collection_name,
+                        "localField": local_field,
+                        "foreignField": "_id",
+                        "as": name,
+                    }
+                }
+            )
+            pipeline.append({"$unwind": f"${name}"})
+
+        sequencing = next(self.sequencings.collection.aggregate(pipeline), None)
+        if sequencing is None:
+            return None
+
+        sample = sequencing.pop("sample_data")
+        biopsy = sequencing.pop("biopsy_data")
+        patient = sequencing.pop("patient_data")
+        project = sequencing.pop("project_data")
+        return {
+            "project": project,
+            "patient": patient,
+            "biopsy": biopsy,
+            "sample": sample,
+            "sequencing": sequencing,
+        }
+
+    def _resolve_sequencing_sequentially(
+        self, sequencing_id: ObjectId
+    ) -> Optional[Dict[str, Dict[str, Any]]]:
         sequencing = self.sequencings.find({"_id": sequencing_id})
         if not sequencing:
             return None
@@ -256,64 +681,58 @@ class Db:
         a `BarcodedFilename`.
 
         It uses the `BarcodedFilename.from_parameters` to create the
-        return value.
+        return value. A `DataError` is raised if `data` does not contain
+        all the parts of a barcode.
         """
         project = data["project"]
-        assert project
-        project_name = project["name"]
-
         patient = data["patient"]
-        assert patient
-        patient_name = patient["name"]
-
         biopsy = data["biopsy"]
-        assert biopsy
+        sample = data["sample"]
+        sequencing = data["sequencing"]
+        if not (project and patient and biopsy and sample and sequencing):
+            raise DataError("incomplete data for a barcoded filename")
+
+        project_name = project["name"]
+        patient_name = patient["name"]
         biopsy_index = biopsy["index"]
         tissue = biopsy["tissue"]
 
-        sample = data["sample"]
-        assert sample
         xenograft_generation: Optional[int]
         xenograft_parent: Optional[int]
         xenograft_child: Optional[int]
         sample_index: Optional[str]
-        if "xenograft" in sample:
-            xenograft = Xenograft.from_dict(sample["xenograft"])
-            assert xenograft
+        xenograft_data = sample.get("xenograft")
+        if xenograft_data is not None:
+            xenograft = Xenograft.from_dict(xenograft_data)
             xenograft_generation = xenograft.generation
             xenograft_parent = xenograft.parent
             xenograft_child = xenograft.child
             sample_index = None
-
-            assert xenograft_generation is not None
-            assert xenograft_parent is not None
-            assert xenograft_child is not None
         else:
             sample_index = sample["index"]
             xenograft_generation = None
             xenograft_parent = None
             xenograft_child = None
 
-            assert sample_index is not None and sample_index != ""
+            if sample_index is None or sample_index == "":
+                raise DataError("sample without index nor xenograft data")
 
-        sequencing = data["sequencing"]
-        assert sequencing
         sequencing_index = sequencing["index"]
         molecule = sequencing["molecule"]
         analyte = sequencing["analyte"]
         # At to date, kit  is unused and can be inexistent
-        if "kit" in sequencing:
-            kit = sequencing["kit"]
-        else:
-            kit = 0
-
-        assert project_name
-        assert patient_name
-        assert biopsy_index is not None
-        assert tissue
-        assert molecule is not None
-        assert analyte is not None
-        assert kit is not None
+        kit = sequencing.get("kit", 0)
+
+        if (
+            not project_name
+            or not patient_name
+            or biopsy_index is None
+            or not tissue
+            or molecule is None
+            or analyte is None
+            or kit is None
+        ):
+            raise DataError("invalid data for a barcoded filename")
 
         return BarcodedFilename.from_parameters(
             project_name,
@@ -101,6 +101,19 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_false",
         help="Skips cutadapt.",
     )
+    parser.add_argument(
+        "--use-fastp",
+        action="store_true",
+        help="Use fastp to clip the adapters and trim the reads in a single "
+        "step, instead of using cutadapt, FastQC and SeqTK.",
+    )
+    parser.add_argument(
+        "--use-samtools-sort",
+        action="store_true",
+        help="Use Samtools to sort the BAM files and to mark the duplicates of "
+        "whole exome samples, instead of Picard. Requires Samtools >= 1.10, "
+        "or >= 1.13 when the read groups are added with Samtools.",
+    )
     parser.add_argument(
         "--no-tdf", dest="use_tdf", action="store_false", help="Skips tdf generation."
     )
@@ -146,6 +159,15 @@ def get_parser() -> argparse.ArgumentParser:
         help="If set, the fastqs files are compressed at the "
         "end of the mapping phase.",
     )
+    parser.add_argument(
+        "--compress-threads",
+        metavar="n",
+        action="store",
+        type=int,
+        default=min(os.cpu_count() or 1, 8),
+        help="Number of threads to be used to compress the fastq files. "
+        "Default=number of CPUs, up to 8.",
+    )
     parser.add_argument(
         "--trim-5",
         action="store",
@@ -171,6 +193,32 @@ def get_parser() -> argparse.ArgumentParser:
         default=20,
         help="Number of threads to be used for GATK. Default=20.",
     )
+    parser.add_argument(
+        "--cutadapt-threads",
+        metavar="n",
+        action="store",
+        type=int,
+        default=min(os.cpu_count() or 1, 8),
+        help="Number of threads to be used for cutadapt or fastp. "
+        "Default=number of CPUs, up to 8.",
+    )
+    parser.add_argument(
+        "--fastqc-threads",
+        metavar="n",
+        action="store",
+        type=int,
+        default=2,
+        help="Number of files FastQC can check in parallel. Default=2.",
+    )
+    parser.add_argument(
+        "--filter-jobs",
+        metavar="n",
+        action="store",
+        type=int,
+        default=min(os.cpu_count() or 1, 8),
+        help="Number of processes used to filter the aligned reads. "
+        "Default=number of CPUs, up to 8.",
+    )
     parser.add_argument(
         "--picard-max-records",
         action="store",
@@ -391,6 +439,10 @@ def main() -> None:
         )
         exit(-1)
 
+    if args.use_fastp and config.fastp is None:
+        print("ERROR: fastp is required but it cannot be executed. Check config.")
+        exit(-1)
+
     if not config.check_files():
         print(
             "ERROR: not every file inside configuration is correctly "
@@ -567,10 +619,16 @@ def main() -> None:
     parameters = {
         "use_xenograft_classifier": args.use_xenograft_classifier,
         "use_cutadapt": args.use_cutadapt,
+        "use_fastp": args.use_fastp,
+        "use_samtools_sort": args.use_samtools_sort,
         "mark_duplicates": args.mark_duplicates,
         "run_post_recalibration": args.post_recalibration,
         "compress_fastq": args.compress_fastq,
+        "compress_threads": args.compress_threads,
         "gatk_threads": args.gatk_threads,
+        "cutadapt_threads": args.cutadapt_threads,
+        "fastqc_threads": args.fastqc_threads,
+        "filter_jobs": args.filter_jobs,
         "picard_max_records": args.picard_max_records,
         "use_normals": args.use_normals,
         "trim_5": args.trim_5,
@@ -4,17 +4,19 @@ NGS data evaluation is not just about alignment, there are many steps
 that are necessary or extremely informative and that have to be handled
 carefully. This module is about all these steps.
 """
-import math
 import os
-import re
-from typing import Any, List, Optional, Sequence, Union
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from typing import Any, Callable, List, Optional, Sequence, Set, Union, cast
 
+from . import samfilter
 from .aligner import Aligner, RnaSeqAligner
 from .core import utils
 from .core.analysis import Analysis
 from .core.barcoded_filename import Analyte, BarcodedFilename
 from .core.exceptions import PipelineError
-from .core.executor import AnalysisFileData, Executor
+from .core.executor import Executor
+from .core.executor_graph import ExecutorGraph
 from .db import Db
 from .db.cutadapt import Cutadapt
 from .db.picard_metrics import PicardMetrics, PicardMetricsType
@@ -30,13 +32,27 @@ class Mapping:
     depends on the sample type and/or command-line parameters.
     """
 
-    def __init__(self, analysis: Analysis, fastq_dir: str) -> None:
+    _ensured_dirs: Set[str] = set()
+
+    def __init__(
+        self, analysis: Analysis, fastq_dir: str, max_mismatch_frac: float = 0.04
+    ) -> None:
         """Create a new instance.
 
         The reports directories are also created if needed.
+
+        Args:
+            analysis: the analysis to perform the mapping for.
+            fastq_dir: the directory containing the FASTQ files.
+            max_mismatch_frac: the maximum fraction of mismatches of a
+                               human read, relative to its length. It
+                               is stored as a ratio of integers, in
+                               order to filter the reads using integer
+                               arithmetic only.
         """
         self.analysis = analysis
         self.fastq_dir = fastq_dir
+        self.max_mismatches = Fraction(max_mismatch_frac).limit_denominator(1000)
 
         self.sample_base = os.path.join(self.fastq_dir, self.analysis.sample)
         self.sample_base_out = os.path.join(
@@ -44,18 +60,75 @@ class Mapping:
         )
         self.output_basename = os.path.join("REPORTS", self.analysis.basename)
 
-        os.makedirs(os.path.join(self.analysis.get_bam_dir(), "REPORTS"), exist_ok=True)
-        os.makedirs(os.path.join(self.fastq_dir, "REPORTS"), exist_ok=True)
+        self._ensure_dir(os.path.join(self.analysis.get_bam_dir(), "REPORTS"))
+        self._ensure_dir(os.path.join(self.fastq_dir, "REPORTS"))
+
+        self.barcoded = BarcodedFilename.from_sample(self.analysis.sample)
+        self.analyte = self.barcoded.analyte
+        self.is_whole_exome = self.analyte == Analyte.WHOLE_EXOME
+        self.has_mate_tags = False
 
         self.gatk_threads = self.analysis.parameters["gatk_threads"]
         self.max_records_str = utils.get_picard_max_records_string(
             self.analysis.parameters["picard_max_records"]
         )
 
+        config = self.analysis.config
+        self.picard_cmd = f"{config.java} {config.picard_jvm_args} -jar {config.picard}"
+        self.gatk_cmd = f"{config.java} {config.gatk_jvm_args} -jar {config.gatk}"
+        self.picard_tmp_args = (
+            f"TMP_DIR={config.temporary_dir}{self.max_records_str}"
+            f"{utils.get_picard_deflater_string(config.picard_jdk_deflater)}"
+        )
+        self.picard_intermediate_args = (
+            f"COMPRESSION_LEVEL={config.picard_intermediate_compression}"
+        )
+
+    @classmethod
+    def _ensure_dir(cls, path: str) -> None:
+        """Create a directory, unless it has already been done.
+
+        The directories created by the current process are remembered,
+        in order to avoid useless filesystem calls when many instances
+        are created, which can be slow on network filesystems.
+        """
+        path = os.path.abspath(path)
+        if path not in cls._ensured_dirs:
+            os.makedirs(path, exist_ok=True)
+            cls._ensured_dirs.add(path)
+
     def chdir(self) -> None:
         """Change current directory to the BAM folder."""
         os.chdir(self.analysis.get_bam_dir())
 
+    def _is_paired_end(self) -> bool:
+        if isinstance(self.analysis.last_operation_filenames, list):
+            return len(self.analysis.last_operation_filenames) == 2
+        elif isinstance(self.analysis.last_operation_filenames, dict):
+            first_filenames = next(
+                iter(self.analysis.last_operation_filenames.values())
+            )
+            assert all(
+                map(
+                    lambda filenames: len(filenames) == len(first_filenames),
+                    self.analysis.last_operation_filenames.values(),
+                )
+            )
+            return len(first_filenames) == 2
+        else:
+            return False
+
+    def _get_trim_3(self) -> Optional[int]:
+        if not self.analysis.parameters["use_xenograft_classifier"]:
+            return None
+
+        trim_3 = self.analysis.parameters["trim_3"]
+        if trim_3 is None:
+            return 10
+        else:
+            assert isinstance(trim_3, int)
+            return trim_3
+
     def cutadapt(self) -> None:
         """Run cutadapt software on the current sample data.
 
@@ -63,7 +136,8 @@ class Mapping:
         single-end or paired-end.
 
         The process uses the adapter information specified in
-        configuration under the kit needed for the sample.
+        configuration under the kit needed for the sample, and it runs
+        with the number of threads in the "cutadapt_threads" parameter.
 
         Results are saved in the database if available.
         """
@@ -72,25 +146,10 @@ class Mapping:
         config = self.analysis.config
 
         report_filename = f"{self.sample_base_out}.cutadapt.txt"
-        if isinstance(self.analysis.last_operation_filenames, list):
-            is_paired_end = len(self.analysis.last_operation_filenames) == 2
-        elif isinstance(self.analysis.last_operation_filenames, dict):
-            first_filenames = next(
-                iter(self.analysis.last_operation_filenames.values())
-            )
-            is_paired_end = len(first_filenames) == 2
-            assert all(
-                map(
-                    lambda filenames: len(filenames) == len(first_filenames),
-                    self.analysis.last_operation_filenames.values(),
-                )
-            )
-        else:
-            is_paired_end = False
-
+        is_paired_end = self._is_paired_end()
+        cutadapt_threads = self.analysis.parameters["cutadapt_threads"]
         executor = Executor(self.analysis)
-        barcoded_sample = BarcodedFilename.from_sample(self.analysis.sample)
-        kit = utils.get_kit_from_barcoded(self.analysis.config, barcoded_sample)
+        kit = utils.get_kit_from_barcoded(self.analysis.config, self.barcoded)
         assert kit
         if is_paired_end:
             if not kit.adapter_r1 or not kit.adapter_r2:
@@ -101,7 +160,7 @@ class Mapping:
                 return
 
             executor(
-                f"cutadapt -a {{kit.adapter_r1}} "
+                f"cutadapt -j {cutadapt_threads} -a {{kit.adapter_r1}} "
                 f"-A {{kit.adapter_r2}} "
                 f'-m 20 -o "{{output_filename[0]}}" -p '
                 f'"{{output_filename[1]}}" {{input_filename}} '
@@ -126,7 +185,7 @@ class Mapping:
                 return
 
             executor(
-                f"cutadapt -a {{kit.adapter_r1}} "
+                f"cutadapt -j {cutadapt_threads} -a {{kit.adapter_r1}} "
                 f'-m 20 -o "{{output_filename}}" '
                 f" {{input_filename}} "
                 f'> "{report_filename}"',
@@ -144,39 +203,49 @@ class Mapping:
 
         self.analysis.logger.info("Finished cutting adapters")
 
-    def fastqc(self) -> None:
+    def fastqc(self, input_filenames: Optional[Sequence[str]] = None) -> None:
         """Run FastQC tool on the input files.
 
-        Results are placed inside BAM reports directory.
+        Results are placed inside BAM reports directory. All the files
+        are given to a single FastQC process, which checks up to
+        "fastqc_threads" files in parallel.
+
+        Args:
+            input_filenames: the FASTQ files to check. When not
+                             specified, the files of the last operation
+                             are used.
         """
         self.analysis.logger.info("Running fastqc")
         self.chdir()
 
+        fastqc_threads = self.analysis.parameters["fastqc_threads"]
         executor = Executor(self.analysis)
         executor(
-            f'{self.analysis.config.fastqc} "{{input_filename}}" --outdir REPORTS',
+            f"{self.analysis.config.fastqc} --threads {fastqc_threads} "
+            f"{{input_filename}} --outdir REPORTS",
+            input_filenames=input_filenames,
+            input_function=lambda filenames: " ".join(
+                f'"{filename}"' for filename in filenames
+            ),
+            input_split_reads=False,
             override_last_files=False,
         )
 
         self.analysis.logger.info("Finished fastqc")
 
-    def trim(self) -> None:
+    def trim(self, unlink_inputs: bool = True) -> None:
         """Trim the 5' and 3' ends of the reads.
 
         Uses SeqTK TrimFQ tool to perform a trimming operation depending
         on the command line parameters.
-        """
-        trim_end = False
-        if self.analysis.parameters["use_xenograft_classifier"]:
-            trim_end = True
 
-        if trim_end:
+        Args:
+            unlink_inputs: whether the untrimmed files are removed.
+        """
+        trim_3 = self._get_trim_3()
+        if trim_3 is not None:
             self.analysis.logger.info("Trimming first 5 bp and last 10 bp")
-            trim_3 = self.analysis.parameters["trim_3"]
-            if trim_3 is None:
-                trim_end_cmd = "-e 10 "
-            else:
-                trim_end_cmd = "-e %d " % trim_3
+            trim_end_cmd = "-e %d " % trim_3
         else:
             self.analysis.logger.info("Trimming first 5 bp")
             trim_end_cmd = ""
@@ -198,86 +267,228 @@ class Mapping:
             ),
             output_path=self.fastq_dir,
             split_by_organism=True,
-            unlink_inputs=True,
+            unlink_inputs=unlink_inputs,
             error_string="Trimming with seqtk exited with status {status}",
             exception_string="trimming error",
         )
 
         self.analysis.logger.info("Finished trimming")
 
-    def _filter_alignment(*args, **kwargs: Sequence[AnalysisFileData]) -> None:
-        """Perform some SAM filtering.
+    def _fastqc_and_trim(self) -> None:
+        """Run `Mapping.fastqc` and `Mapping.trim` concurrently.
+
+        FastQC only produces reports, therefore it can read the FASTQ
+        files while they are trimmed. The untrimmed files are removed
+        once both the steps are completed, if they could have been
+        removed before trimming. Trimming sets `analysis.can_unlink`,
+        therefore its value must be read before running the steps.
+        """
+        last_filenames = self.analysis.last_operation_filenames
+        assert last_filenames is not None
+        fastq_filenames = cast(List[str], utils.get_sample_filenames(last_filenames))
+        can_unlink = self.analysis.can_unlink
+
+        graph = ExecutorGraph(jobs=2)
+        graph.add("fastqc", lambda: self.fastqc(fastq_filenames))
+        graph.add("trim", lambda: self.trim(unlink_inputs=False))
+        graph.run()
+
+        if can_unlink and not self.analysis.run_fake:
+            for filename in fastq_filenames:
+                os.unlink(filename)
+
+    def fastp(self) -> None:
+        """Run fastp to clip the adapters and to trim the reads.
+
+        This step replaces `Mapping.cutadapt`, `Mapping.fastqc` and
+        `Mapping.trim` when the "use_fastp" parameter is set, performing
+        all the operations in a single multi-threaded pass. Adapters are
+        clipped in the same cases cutadapt would be run, and the quality
+        reports are saved inside BAM reports directory. The poly-G tail
+        trimming, that fastp enables by default for NovaSeq and NextSeq
+        data, is disabled because the other tools do not perform it.
+        """
+        self.analysis.logger.info("Running fastp")
+        self.chdir()
+        config = self.analysis.config
+
+        kit = utils.get_kit_from_barcoded(config, self.barcoded)
+        assert kit
+        is_paired_end = self._is_paired_end()
+
+        clip_adapters = self.is_whole_exome and self.analysis.parameters["use_cutadapt"]
+        if clip_adapters and is_paired_end:
+            if kit.adapter_r1 and kit.adapter_r2:
+                adapters_cmd = (
+                    f"--adapter_sequence {kit.adapter_r1} "
+                    f"--adapter_sequence_r2 {kit.adapter_r2} "
+                )
+            else:
+                self.analysis.logger.warning(
+                    "fastp needs both adapter to perform "
+                    "a paired-end clipping. Skipping adapters clipping"
+                )
+                adapters_cmd = "--disable_adapter_trimming "
+        elif clip_adapters and kit.adapter_r1:
+            adapters_cmd = f"--adapter_sequence {kit.adapter_r1} "
+        else:
+            if clip_adapters:
+                self.analysis.logger.warning(
+                    "fastp needs the R1 adapter to perform "
+                    "a single end clipping. Skipping adapters clipping"
+                )
+            adapters_cmd = "--disable_adapter_trimming "
+
+        trim_5 = self.analysis.parameters["trim_5"]
+        trim_3 = self._get_trim_3()
+        trim_cmd = f"--trim_front1 {trim_5} "
+        if trim_3 is not None:
+            trim_cmd += f"--trim_tail1 {trim_3} "
+        if is_paired_end:
+            trim_cmd += f"--trim_front2 {trim_5} "
+            if trim_3 is not None:
+                trim_cmd += f"--trim_tail2 {trim_3} "
+
+        fastp_threads = self.analysis.parameters["cutadapt_threads"]
+
+        def run_fastp(**kwargs: Any) -> None:
+            input_filenames = sorted(
+                file_data.filename for file_data in kwargs["input_filenames"]
+            )
+            output_filenames = kwargs["output_filename"]
+            if isinstance(output_filenames, str):
+                output_filenames = [output_filenames]
+            report_basename = f"{self.output_basename}.fastp{kwargs['organism_str']}"
+
+            inputs_cmd = "".join(
+                f'--in{index + 1} "{filename}" '
+                for index, filename in enumerate(input_filenames)
+            )
+            outputs_cmd = "".join(
+                f'--out{index + 1} "{filename}" '
+                for index, filename in enumerate(output_filenames)
+            )
+            status = utils.run_and_log(
+                f"{config.fastp} {inputs_cmd}{outputs_cmd}"
+                f"{adapters_cmd}{trim_cmd}"
+                f"--length_required 20 --disable_quality_filtering "
+                f"--disable_trim_poly_g "
+                f"--thread {fastp_threads} "
+                f'--json "{report_basename}.json" '
+                f'--html "{report_basename}.html"',
+                self.analysis.logger,
+            )
+            if status != 0:
+                self.analysis.logger.error("fastp exited with status %d", status)
+                raise PipelineError("fastp error")
+
+        if is_paired_end:
+            output_format = f"{self.analysis.sample}.trimmed{{organism_str}}.R%d.fastq"
+            output_function: Optional[Callable[[str], List[str]]] = (
+                lambda filename: [filename % (index + 1) for index in range(2)]
+            )
+        else:
+            output_format = f"{self.analysis.sample}.trimmed{{organism_str}}.R1.fastq"
+            output_function = None
+
+        executor = Executor(self.analysis)
+        executor(
+            run_fastp,
+            output_format=output_format,
+            input_split_reads=False,
+            split_by_organism=True,
+            output_path=self.fastq_dir,
+            unlink_inputs=True,
+            output_function=output_function,
+        )
+
+        self.analysis.logger.info("Finished fastp")
+
+    def _filter_alignment_to_bam(self, *args: Any, **kwargs: Any) -> None:
+        """Filter a SAM file while converting it to BAM.
 
-        Keep only aligned reads with maximum of N mismatches and without
-        Ns, hard clipping and padding.
+        Human alignments are filtered by `samfilter.filter_sam_to_stream`,
+        using up to "filter_jobs" processes, and the kept records are
+        streamed to Samtools, which writes the BAM. The other alignments
+        are just converted.
         """
         if len(kwargs["input_filenames"]) != 1:
             raise PipelineError("Expected a list with only one file")
         input_filename: str = kwargs["input_filenames"][0].filename
-        tmp_filename = input_filename + ".tmp"
-        reSpaces = re.compile(r"\s+")
-        reCigar = re.compile(r"N|H|P")
-        with open(input_filename) as fd, open(tmp_filename, "w") as tmp_fd:
-            for line in fd:
-                if line[0] == "@":
-                    tmp_fd.write(line)
-                    continue
-
-                params = reSpaces.split(line)
-                if reCigar.search(params[5]):
-                    continue
-
-                read_length = len(params[9])
-
-                params = params[11:]
-                mutations = float("inf")
-                for param in params:
-                    if param.startswith("NM:i:"):
-                        mutations = int(param[5:])
-                        break
-
-                if mutations > math.floor(read_length * 0.04):
-                    continue
-
-                tmp_fd.write(line)
-        os.rename(tmp_filename, input_filename)
+        output_filename: str = kwargs["output_filename"]
+        config = self.analysis.config
+        logger = self.analysis.logger
+
+        if kwargs["organism"].startswith("hg"):
+            filter_jobs = self.analysis.parameters["filter_jobs"]
+            status = utils.run_and_log_piped(
+                f"{config.samtools} view -@ {self.gatk_threads} -b "
+                f'-o "{output_filename}" -',
+                logger,
+                lambda fd: samfilter.filter_sam_to_stream(
+                    input_filename, fd, filter_jobs, self.max_mismatches
+                ),
+            )
+        else:
+            status = utils.run_and_log(
+                f"{config.samtools} view -@ {self.gatk_threads} -b "
+                f'-o "{output_filename}" "{input_filename}"',
+                logger,
+            )
+
+        if status != 0:
+            logger.error("samtools view exited with status %d", status)
+            raise PipelineError("samtools view error")
 
     def convert_to_bam(self) -> None:
         """Filter the SAM file and convert the content to BAM.
 
         The filtering process discards all the reads with a number of
         mutations above 4% of the length of the read and in case of Ns,
-        hard clipping or padding.
+        hard clipping or padding. It is only performed on human data.
 
-        The conversion to BAM is performed by Picard SamFormatConverter.
+        The filtered reads are streamed to Samtools view, which performs
+        the conversion to BAM, therefore the filtered SAM is never
+        written to disk.
         """
         self.chdir()
-        config = self.analysis.config
         executor = Executor(self.analysis)
-        executor(
-            self._filter_alignment,
-            input_split_reads=False,
-            split_by_organism=True,
-            only_human=True,
-            override_last_files=False,
-        )
-
         self.analysis.logger.info("Alignment SAM -> BAM")
         executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"SamFormatConverter "
-            f"I={{input_filename}} "
-            f"O={{output_filename}} "
-            f"TMP_DIR={config.temporary_dir}"
-            f"{self.max_records_str}",
+            self._filter_alignment_to_bam,
             output_format=f"{self.analysis.basename}{{organism_str}}.bam",
-            error_string="Picard SamFormatConverter exited with status {status}",
-            exception_string="picard SamFormatConverter error",
+            input_split_reads=False,
             split_by_organism=True,
             unlink_inputs=True,
         )
         self.analysis.logger.info("Finished alignment SAM->BAM")
 
+    def _rename_last_files(
+        self, output_format: str, with_bam_index: bool = False
+    ) -> None:
+        """Rename the files of the last operation.
+
+        The files are moved in-process using `os.replace`, but the
+        `Executor` is still used in order to handle the organisms, the
+        last operation files and the fake runs consistently.
+
+        Args:
+            output_format: the format of the new filenames.
+            with_bam_index: whether the BAM files have a ".bam.bai"
+                            index that must be renamed as well.
+        """
+
+        def rename_files(**kwargs: Any) -> None:
+            filename = kwargs["input_filename"].filename
+            output_filename = kwargs["output_filename"]
+            os.replace(filename, output_filename)
+            if with_bam_index:
+                assert os.path.splitext(filename)[1].lower() == ".bam"
+                os.replace(f"{filename}.bai", f"{output_filename}.bai")
+
+        executor = Executor(self.analysis)
+        executor(rename_files, output_format=output_format, split_by_organism=True)
+
     def create_bam_index(self) -> None:
         """Sort BAM and create BAI.
 
@@ -300,17 +511,8 @@ class Mapping:
             override_last_files=False,
         )
 
-        def rename_files(*args: Any, **kwargs: Any) -> None:
-            bam_filename = kwargs["input_filename"].filename
-            assert os.path.splitext(bam_filename)[1].lower() == ".bam"
-            output_bam_filename = kwargs["output_filename"]
-            os.rename(bam_filename, output_bam_filename)
-            os.rename(f"{bam_filename}.bai", f"{output_bam_filename}.bai")
-
-        executor(
-            rename_files,
-            split_by_organism=True,
-            output_format=f"{self.analysis.basename}{{organism_str}}.bam",
+        self._rename_last_files(
+            f"{self.analysis.basename}{{organism_str}}.bam", with_bam_index=True
         )
 
         self.analysis.logger.info("Finished sorting and creating BAI file")
@@ -318,37 +520,55 @@ class Mapping:
     def add_bam_groups(self) -> None:
         """Add/replace read groups to BAM.
 
-        It uses Picard AddOrReplaceReadGroups to correctly handle the
-        groups for the analysis. At the end of the process
+        It uses Samtools addreplacerg to correctly handle the groups for
+        the analysis, or Picard AddOrReplaceReadGroups when
+        `use_picard_read_groups` is set in the configuration. Samtools
+        addreplacerg needs Samtools 1.13 or newer, and a `PipelineError`
+        is raised for older versions. At the end of the process
         `Mapping.create_bam_index` is run.
         """
         self.chdir()
         config = self.analysis.config
         executor = Executor(self.analysis)
         self.analysis.logger.info("Adding/replacing read groups to BAM")
-        executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"AddOrReplaceReadGroups "
-            f"I={{input_filename}} "
-            f"O={{output_filename}} RGID={self.analysis.basename} "
-            f"RGLB=lib1 RGPL=ILLUMINA RGPU={{kit.name}} "
-            f"RGSM={self.analysis.basename} "
-            f"TMP_DIR={config.temporary_dir}"
-            f"{self.max_records_str}",
-            output_format=f"{self.analysis.basename}.rg{{organism_str}}.bam",
-            error_string="Picard AddOrReplaceReadGroups exited with status {status}",
-            exception_string="picard AddOrReplaceReadGroups error",
-            split_by_organism=True,
-            unlink_inputs=True,
-        )
+        if config.use_picard_read_groups:
+            executor(
+                f"{self.picard_cmd} AddOrReplaceReadGroups "
+                f"I={{input_filename}} "
+                f"O={{output_filename}} RGID={self.analysis.basename} "
+                f"RGLB=lib1 RGPL=ILLUMINA RGPU={{kit.name}} "
+                f"RGSM={self.analysis.basename} "
+                f"{self.picard_intermediate_args} "
+                f"{self.picard_tmp_args}",
+                output_format=f"{self.analysis.basename}.rg{{organism_str}}.bam",
+                error_string="Picard AddOrReplaceReadGroups exited with status "
+                "{status}",
+                exception_string="picard AddOrReplaceReadGroups error",
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
+        else:
+            samtools_version = utils.get_samtools_version(config.samtools)
+            if samtools_version is None or samtools_version < (1, 13):
+                self.analysis.logger.error(
+                    "Samtools addreplacerg needs Samtools 1.13 or newer. "
+                    "Update Samtools or set use_picard_read_groups"
+                )
+                raise PipelineError("unsupported samtools version")
 
-        executor(
-            lambda **kwargs: os.rename(
-                kwargs["input_filename"].filename, kwargs["output_filename"]
-            ),
-            output_format=f"{self.analysis.basename}{{organism_str}}.bam",
-            split_by_organism=True,
-        )
+            executor(
+                f"{config.samtools} addreplacerg -@ {self.gatk_threads} -w "
+                f'-r "ID:{self.analysis.basename}\\tLB:lib1\\tPL:ILLUMINA\\t'
+                f'PU:{{kit.name}}\\tSM:{self.analysis.basename}" '
+                f"-o {{output_filename}} {{input_filename}}",
+                output_format=f"{self.analysis.basename}.rg{{organism_str}}.bam",
+                error_string="samtools addreplacerg exited with status {status}",
+                exception_string="samtools addreplacerg error",
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
+
+        self._rename_last_files(f"{self.analysis.basename}{{organism_str}}.bam")
         self.create_bam_index()
 
         self.analysis.logger.info("Finished adding/replacing read groups to BAM")
@@ -357,13 +577,18 @@ class Mapping:
         """Mark duplicates depending on the analyte.
 
         In case the sample is a whole exome, Picard MarkDuplicates is
-        used. Otherwise, when the sample is a gene panel, there are more
-        steps involved. Picard FixMateInformation is used to perform the
-        mate-pair information, then the reads with the mate-pair tag are
-        given to Picard UmiAwareMarkDuplicatesWithMateCigar.
-
-        In both cases the results are stored in the database if
-        possible.
+        used, unless the BAM has been sorted by `Aligner.sort_bam` with
+        the "use_samtools_sort" parameter set. In this case Samtools
+        markdup is used instead, relying on the mate tags added during
+        the sorting, and its statistics are only saved in the reports
+        directory. Otherwise, when the sample is a gene
+        panel, there are more steps involved. Picard FixMateInformation
+        is used to perform the mate-pair information, then the reads
+        with the mate-pair tag are extracted, together with the header,
+        in a single Samtools pass and given to Picard
+        UmiAwareMarkDuplicatesWithMateCigar.
+
+        The Picard results are stored in the database if possible.
 
         At to date only these two type of analyte are handled.
         """
@@ -372,18 +597,32 @@ class Mapping:
         config = self.analysis.config
 
         executor = Executor(self.analysis)
-        barcoded = BarcodedFilename.from_sample(self.analysis.sample)
-        if barcoded.analyte == Analyte.WHOLE_EXOME:
+        if self.is_whole_exome and self.has_mate_tags:
+            marked_basename = f"{self.analysis.basename}.srt.marked.dup{{organism_str}}"
             executor(
-                f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-                f"MarkDuplicates "
+                f"{config.samtools} markdup -@ {self.gatk_threads} "
+                f"-T {config.temporary_dir}/{self.analysis.basename}.markdup"
+                f"{{organism_str}} "
+                f"-f {self.output_basename}.markdup_stats{{organism_str}}.txt "
+                f"--write-index "
+                f"{{input_filename}} "
+                f"{{output_filename}}##idx##{marked_basename}.bai",
+                output_format=f"{marked_basename}.bam",
+                error_string="samtools markdup exited with status {status}",
+                exception_string="samtools markdup error",
+                split_by_organism=True,
+                unlink_inputs=True,
+            )
+        elif self.is_whole_exome:
+            executor(
+                f"{self.picard_cmd} MarkDuplicates "
                 f"I={{input_filename}} "
                 f"O={{output_filename}} "
                 f"M={self.output_basename}.marked_dup_metrics"
                 f"{{organism_str}}.txt "
                 f"CREATE_INDEX=true "
-                f"TMP_DIR={config.temporary_dir}"
-                f"{self.max_records_str}",
+                f"{self.picard_intermediate_args} "
+                f"{self.picard_tmp_args}",
                 output_format=f"{self.analysis.basename}.srt.marked.dup"
                 f"{{organism_str}}.bam",
                 error_string="Picard MarkDuplicates exited with status {status}",
@@ -405,16 +644,15 @@ class Mapping:
                 split_by_organism=True,
                 override_last_files=False,
             )
-        elif barcoded.analyte == Analyte.GENE_PANEL:
+        elif self.analyte == Analyte.GENE_PANEL:
             executor(
-                f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-                f"FixMateInformation "
+                f"{self.picard_cmd} FixMateInformation "
                 f"I={{input_filename}} "
                 f"O={{output_filename}} "
                 f"ADD_MATE_CIGAR=true "
                 f"IGNORE_MISSING_MATES=true "
-                f"TMP_DIR={config.temporary_dir}"
-                f"{self.max_records_str}",
+                f"{self.picard_intermediate_args} "
+                f"{self.picard_tmp_args}",
                 output_format=f"{self.analysis.basename}.srt.mc"
                 f"{{organism_str}}.bam",
                 error_string="Picard FixMateInformation exited with status {status}",
@@ -424,30 +662,18 @@ class Mapping:
             )
 
             executor(
-                f"{config.samtools} view -H "
-                f"{{input_filename}} > {{output_filename}}",
+                f"{config.samtools} view -@ {self.gatk_threads} -h "
+                f'{{input_filename}} | grep -E "^@|MC:" > {{output_filename}}',
                 output_format=f"{self.analysis.basename}.srt.mc.filtered"
                 f"{{organism_str}}.sam",
                 error_string="samtools view exited with status {status}",
                 exception_string="samtools view error",
                 split_by_organism=True,
-                override_last_files=False,
-            )
-
-            executor(
-                f"{config.samtools} view "
-                f'{{input_filename}} | grep "MC:" >> {{output_filename}}',
-                output_format=f"{self.analysis.basename}.str.mc.filtered"
-                f"{{organism_str}}.sam",
-                error_string="samtools view exited with status {status}",
-                exception_string="samtools view error",
-                split_by_organism=True,
                 unlink_inputs=True,
             )
 
             executor(
-                f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-                f"UmiAwareMarkDuplicatesWithMateCigar "
+                f"{self.picard_cmd} UmiAwareMarkDuplicatesWithMateCigar "
                 f"I={{input_filename}} "
                 f"O={{output_filename}} "
                 f"UMI_METRICS_FILE={self.output_basename}.UMI_metrics"
@@ -458,8 +684,7 @@ class Mapping:
                 f"CREATE_INDEX=true "
                 f"TAGGING_POLICY=All "
                 f"REMOVE_DUPLICATES=true "
-                f"TMP_DIR={config.temporary_dir}"
-                f"{self.max_records_str}",
+                f"{self.picard_tmp_args}",
                 output_format=f"{self.analysis.basename}.srt.no_duplicates"
                 f"{{organism_str}}.bam",
                 error_string="Picard UmiAwareMarkDuplicatesWithMateCigar "
@@ -508,12 +733,10 @@ class Mapping:
         The parameters are extracted from the configuration in
         relationship of the kit and the analyte for the current sample.
         """
-        barcoded = BarcodedFilename.from_sample(self.analysis.sample)
         self.analysis.logger.info("Running indel realignment")
         self.chdir()
-        config = self.analysis.config
         rnaseq_parameter = ""
-        if barcoded.analyte == Analyte.RNASEQ:
+        if self.analyte == Analyte.RNASEQ:
             rnaseq_parameter = "-U ALLOW_N_CIGAR_READS "
         executor = Executor(self.analysis)
 
@@ -527,8 +750,7 @@ class Mapping:
         executor(indels_getter, override_last_files=False)
 
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T RealignerTargetCreator -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T RealignerTargetCreator -R {{genome_ref}} "
             f"-I {{input_filename}} -nt {self.gatk_threads} "
             f"{indels_getter.repr} "
             f"{rnaseq_parameter}"
@@ -543,8 +765,7 @@ class Mapping:
         )
 
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T IndelRealigner -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T IndelRealigner -R {{genome_ref}} "
             f"-I {{input_filename}} "
             f"{indels_getter.repr} "
             f"{rnaseq_parameter}"
@@ -583,14 +804,12 @@ class Mapping:
         """
         self.analysis.logger.info("Running base recalibration")
         self.chdir()
-        config = self.analysis.config
         rnaseq_parameter = ""
         if self.analysis.parameters["aligner"] in RnaSeqAligner:
             rnaseq_parameter = "-U ALLOW_N_CIGAR_READS "
         executor = Executor(self.analysis)
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T BaseRecalibrator -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T BaseRecalibrator -R {{genome_ref}} "
             f"-I {{input_filename}} -nct {self.gatk_threads} "
             f"-knownSites {{dbsnp}} "
             f"{rnaseq_parameter}"
@@ -604,8 +823,7 @@ class Mapping:
         )
 
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T PrintReads -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T PrintReads -R {{genome_ref}} "
             f"{rnaseq_parameter}"
             f"-I {{input_filename}} -nct {self.gatk_threads} "
             f"-BQSR {self.output_basename}.recalibration"
@@ -624,8 +842,7 @@ class Mapping:
             return
 
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T BaseRecalibrator -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T BaseRecalibrator -R {{genome_ref}} "
             f"{rnaseq_parameter}"
             f"-I {{input_filename}} -knownSites {{dbsnp}} "
             f"-L {{kit.target_list}} -ip 50 "
@@ -639,8 +856,7 @@ class Mapping:
         )
 
         executor(
-            f"{config.java} {config.gatk_jvm_args} -jar {config.gatk} "
-            f"-T AnalyzeCovariates -R {{genome_ref}} "
+            f"{self.gatk_cmd} -T AnalyzeCovariates -R {{genome_ref}} "
             f"{rnaseq_parameter}"
             f"-before {self.output_basename}.recalibration"
             f"{{organism_str}}.table "
@@ -655,15 +871,13 @@ class Mapping:
         )
 
         executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"MarkDuplicates "
+            f"{self.picard_cmd} MarkDuplicates "
             f"{rnaseq_parameter}"
             f"I={{input_filename}} O={{output_filename}} "
             f"REMOVE_DUPLICATES=true "
             f"M={self.output_basename}.no_dup_metrics{{organism_str}}.txt "
             f"CREATE_INDEX=true "
-            f"TMP_DIR={config.temporary_dir}"
-            f"{self.max_records_str}",
+            f"{self.picard_tmp_args}",
             output_format=f"{self.analysis.basename}"
             ".srt.realigned.recal.no_dup"
             f"{{organism_str}}.bam",
@@ -693,74 +907,78 @@ class Mapping:
         """Collect some metrics from the data.
 
         Picard CollectHsMetrics and Picard CollectGcBiasMetrics are run
-        and the output is stored into the database, if possible.
+        concurrently, since they only read the same BAM file, and the
+        output is stored into the database, if possible.
         """
         self.analysis.logger.info("Running metrics collection")
         self.chdir()
-        config = self.analysis.config
 
         db = Db(self.analysis.config)
         picard_metrics = PicardMetrics(db)
 
-        executor = Executor(self.analysis)
-        executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"CollectHsMetrics "
-            f"I={{input_filename}} BI={{kit.bait_list}} "
-            f"TI={{kit.target_list}} R={{genome_ref}} "
-            f"O={self.output_basename}.hs_metrics{{organism_str}}.txt "
-            f"MINIMUM_MAPPING_QUALITY=0 "
-            f"MINIMUM_BASE_QUALITY=0 "
-            f"COVERAGE_CAP=10000 "
-            f"CLIP_OVERLAPPING_READS=false "
-            f"PER_BASE_COVERAGE={self.output_basename}.coverage"
-            f"{{organism_str}}.txt "
-            f"TMP_DIR={config.temporary_dir}"
-            f"{self.max_records_str}",
-            error_string="Picard CollectHsMetrics exited with status {status}",
-            exception_string="picard CollectHsMetrics error",
-            split_by_organism=True,
-            override_last_files=False,
-        )
+        def collect_hs_metrics() -> None:
+            executor = Executor(self.analysis)
+            executor(
+                f"{self.picard_cmd} CollectHsMetrics "
+                f"I={{input_filename}} BI={{kit.bait_list}} "
+                f"TI={{kit.target_list}} R={{genome_ref}} "
+                f"O={self.output_basename}.hs_metrics{{organism_str}}.txt "
+                f"MINIMUM_MAPPING_QUALITY=0 "
+                f"MINIMUM_BASE_QUALITY=0 "
+                f"COVERAGE_CAP=10000 "
+                f"CLIP_OVERLAPPING_READS=false "
+                f"PER_BASE_COVERAGE={self.output_basename}.coverage"
+                f"{{organism_str}}.txt "
+                f"{self.picard_tmp_args}",
+                error_string="Picard CollectHsMetrics exited with status {status}",
+                exception_string="picard CollectHsMetrics error",
+                split_by_organism=True,
+                override_last_files=False,
+            )
 
-        executor(
-            lambda *args, **kwargs: picard_metrics.store_from_file(
-                self.analysis,
-                f"{self.output_basename}.hs_metrics{{}}.txt".format(
-                    kwargs["organism_str"]
+            executor(
+                lambda *args, **kwargs: picard_metrics.store_from_file(
+                    self.analysis,
+                    f"{self.output_basename}.hs_metrics{{}}.txt".format(
+                        kwargs["organism_str"]
+                    ),
+                    PicardMetricsType.hs,
                 ),
-                PicardMetricsType.hs,
-            ),
-            split_by_organism=True,
-            override_last_files=False,
-        )
+                split_by_organism=True,
+                override_last_files=False,
+            )
 
-        executor(
-            f"{config.java} {config.picard_jvm_args} -jar {config.picard} "
-            f"CollectGcBiasMetrics "
-            f"R={{genome_ref}} I={{input_filename}} "
-            f"O={self.output_basename}.gcbias.metrics{{organism_str}}.txt "
-            f"CHART={self.output_basename}.gcbias_metrics{{organism_str}}.pdf "
-            f"S={self.output_basename}.gcbias_summ_metrics{{organism_str}}.txt "
-            f"TMP_DIR={config.temporary_dir}"
-            f"{self.max_records_str}",
-            error_string="Picard CollectGcBiasMetrics exited with status {status}",
-            exception_string="picard CollectGcBiasMetrics error",
-            split_by_organism=True,
-            override_last_files=False,
-        )
+        def collect_gc_bias_metrics() -> None:
+            executor = Executor(self.analysis)
+            executor(
+                f"{self.picard_cmd} CollectGcBiasMetrics "
+                f"R={{genome_ref}} I={{input_filename}} "
+                f"O={self.output_basename}.gcbias.metrics{{organism_str}}.txt "
+                f"CHART={self.output_basename}.gcbias_metrics{{organism_str}}.pdf "
+                f"S={self.output_basename}.gcbias_summ_metrics{{organism_str}}.txt "
+                f"{self.picard_tmp_args}",
+                error_string="Picard CollectGcBiasMetrics exited with status {status}",
+                exception_string="picard CollectGcBiasMetrics error",
+                split_by_organism=True,
+                override_last_files=False,
+            )
 
-        executor(
-            lambda *args, **kwargs: picard_metrics.store_from_file(
-                self.analysis,
-                f"{self.output_basename}.gcbias.metrics{{}}.txt".format(
-                    kwargs["organism_str"]
+            executor(
+                lambda *args, **kwargs: picard_metrics.store_from_file(
+                    self.analysis,
+                    f"{self.output_basename}.gcbias.metrics{{}}.txt".format(
+                        kwargs["organism_str"]
+                    ),
+                    PicardMetricsType.gcbias,
                 ),
-                PicardMetricsType.gcbias,
-            ),
-            split_by_organism=True,
-            override_last_files=False,
-        )
+                split_by_organism=True,
+                override_last_files=False,
+            )
+
+        graph = ExecutorGraph(jobs=2)
+        graph.add("hs_metrics", collect_hs_metrics)
+        graph.add("gc_bias_metrics", collect_gc_bias_metrics)
+        graph.run()
 
         self.analysis.logger.info("Finished metrics collection")
 
@@ -784,17 +1002,44 @@ class Mapping:
         )
 
     def compress_fastq(self) -> None:
-        """Compress the fastq data using gzip compression."""
+        """Compress the fastq data using gzip compression.
+
+        The files are compressed using pigz, if available, or using a
+        pool of threads otherwise. In both cases the number of threads
+        is given by the "compress_threads" parameter.
+        """
         self.analysis.logger.info("Compressing fastq files")
         self.chdir()
         fastq_files = utils.find_fastqs_by_organism(
             self.analysis.sample,
             self.fastq_dir,
-            utils.get_human_annotation(self.analysis.config),
+            self.analysis.human_annotation,
         )
-        for filenames in fastq_files.values():
-            for filename, _ in filenames:
-                utils.gzip(filename)
+        filenames = [
+            filename
+            for organism_filenames in fastq_files.values()
+            for filename, _ in organism_filenames
+        ]
+        if not filenames:
+            self.analysis.logger.info("Finished compressing fastq files")
+            return
+
+        config = self.analysis.config
+        compress_threads = self.analysis.parameters["compress_threads"]
+        if config.pigz is not None:
+            quoted_filenames = " ".join(f'"{filename}"' for filename in filenames)
+            status = utils.run_and_log(
+                f"{config.pigz} -6 -p {compress_threads} {quoted_filenames}",
+                self.analysis.logger,
+            )
+            if status != 0:
+                self.analysis.logger.error("pigz exited with status %d", status)
+                raise PipelineError("pigz error")
+        else:
+            with ThreadPoolExecutor(max_workers=compress_threads) as pool:
+                for _ in pool.map(utils.gzip, filenames):
+                    pass
+
         self.analysis.logger.info("Finished compressing fastq files")
 
     def run(self) -> None:
@@ -811,11 +1056,9 @@ class Mapping:
         if self.analysis.parameters["skip_mapping"]:
             self.analysis.run_fake = True
 
-        barcoded = BarcodedFilename.from_sample(self.analysis.sample)
-
         parsing_xenograft = (
             self.analysis.parameters["use_xenograft_classifier"]
-            and barcoded.is_xenograft()
+            and self.barcoded.is_xenograft()
         )
         if parsing_xenograft:
             xenograft = Xenograft(self.analysis, self.fastq_dir)
@@ -823,35 +1066,39 @@ class Mapping:
             if xenograft.classifier == XenograftClassifier.XENOME:
                 xenograft.run()
 
-        if barcoded.analyte == Analyte.WHOLE_EXOME:
-            if self.analysis.parameters["use_cutadapt"]:
-                self.cutadapt()
+        if self.analysis.parameters["use_fastp"]:
+            self.fastp()
+        else:
+            if self.is_whole_exome:
+                if self.analysis.parameters["use_cutadapt"]:
+                    self.cutadapt()
 
-        self.fastqc()
-        self.trim()
+            self._fastqc_and_trim()
 
         if parsing_xenograft and xenograft.classifier != XenograftClassifier.XENOME:
             xenograft.run()
             self.add_bam_groups()
         else:
-            aligner = Aligner(self.analysis)
+            aligner = Aligner(self.analysis, self.max_mismatches)
             aligner.run()
 
-            self.convert_to_bam()
+            if not aligner.filtered_to_bam:
+                self.convert_to_bam()
             self.add_bam_groups()
             aligner.sort_bam()
+            self.has_mate_tags = self.analysis.parameters["use_samtools_sort"]
 
         if (
             self.analysis.parameters["mark_duplicates"]
-            and barcoded.analyte != Analyte.RNASEQ
+            and self.analyte != Analyte.RNASEQ
         ):
             self.mark_duplicates()
 
-        if barcoded.analyte == Analyte.WHOLE_EXOME:
+        if self.is_whole_exome:
             self.indel_realign()
             self.recalibration()
 
-        if barcoded.analyte != Analyte.RNASEQ:
+        if self.analyte != Analyte.RNASEQ:
             self.metrics_collection()
 
         if self.analysis.parameters["use_tdf"]:
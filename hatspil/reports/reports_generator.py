@@ -587,6 +587,7 @@ class ReportsGenerator:
         self, samples: Iterable[Dict[str, Any]], sample_figures: FiguresType
     ) -> None:
         added_samples: Set[str] = set()
+        samples_with_metrics = self._get_barcoded_samples_with_metrics(samples)
 
         for current_sample in samples:
             if current_sample["sample"]["_id"] in added_samples:
@@ -596,13 +597,7 @@ class ReportsGenerator:
             assert current_sample_barcoded
 
             controls_to_check = []
-            for sample in samples:
-                if not self._has_metrics_data(sample["sequencing"]["_id"]):
-                    continue
-
-                sample_barcoded = Db.to_barcoded(sample)
-                assert sample_barcoded
-
+            for sample, sample_barcoded in samples_with_metrics:
                 if (
                     current_sample_barcoded.project == sample_barcoded.project
                     and current_sample_barcoded.patient == sample_barcoded.patient
@@ -640,6 +635,7 @@ class ReportsGenerator:
         self, samples: Iterable[Dict[str, Any]], biopsy_figures: FiguresType
     ) -> None:
         added_biopsies: Set[str] = set()
+        samples_with_metrics = self._get_barcoded_samples_with_metrics(samples)
 
         for current_sample in samples:
             if current_sample["biopsy"]["_id"] in added_biopsies:
@@ -649,13 +645,7 @@ class ReportsGenerator:
             assert current_sample_barcoded
 
             controls_to_check = []
-            for sample in samples:
-                if not self._has_metrics_data(sample["sequencing"]["_id"]):
-                    continue
-
-                sample_barcoded = Db.to_barcoded(sample)
-                assert sample_barcoded
-
+            for sample, sample_barcoded in samples_with_metrics:
                 if (
                     current_sample_barcoded.project == sample_barcoded.project
                     and current_sample_barcoded.patient == sample_barcoded.patient
@@ -693,6 +683,7 @@ class ReportsGenerator:
         self, samples: Iterable[Dict[str, Any]], patient_figures: FiguresType
     ) -> None:
         added_patients: Set[str] = set()
+        samples_with_metrics = self._get_barcoded_samples_with_metrics(samples)
 
         for current_sample in samples:
             if current_sample["patient"]["_id"] in added_patients:
@@ -702,13 +693,7 @@ class ReportsGenerator:
             assert current_sample_barcoded
 
             controls_to_check = []
-            for sample in samples:
-                if not self._has_metrics_data(sample["sequencing"]["_id"]):
-                    continue
-
-                sample_barcoded = Db.to_barcoded(sample)
-                assert sample_barcoded
-
+            for sample, sample_barcoded in samples_with_metrics:
                 if (
                     current_sample_barcoded.project == sample_barcoded.project
                     and current_sample_barcoded.patient == sample_barcoded.patient
@@ -740,6 +725,7 @@ class ReportsGenerator:
         self, samples: Iterable[Dict[str, Any]], project_figures: FiguresType
     ) -> None:
         added_projects: Set[str] = set()
+        samples_with_metrics = self._get_barcoded_samples_with_metrics(samples)
 
         for current_sample in samples:
             if current_sample["project"]["_id"] in added_projects:
@@ -749,13 +735,7 @@ class ReportsGenerator:
             assert current_sample_barcoded
 
             controls_to_check = []
-            for sample in samples:
-                if not self._has_metrics_data(sample["sequencing"]["_id"]):
-                    continue
-
-                sample_barcoded = Db.to_barcoded(sample)
-                assert sample_barcoded
-
+            for sample, sample_barcoded in samples_with_metrics:
                 if current_sample_barcoded.project == sample_barcoded.project:
                     controls_to_check.append(sample)
 
@@ -777,6 +757,20 @@ class ReportsGenerator:
                     project_figures.setdefault(barcoded_sample.project, []),
                 )
 
+    def _get_barcoded_samples_with_metrics(
+        self, samples: Iterable[Dict[str, Any]]
+    ) -> List[Tuple[Dict[str, Any], BarcodedFilename]]:
+        samples_with_metrics = []
+        for sample in samples:
+            if not self._has_metrics_data(sample["sequencing"]["_id"]):
+                continue
+
+            sample_barcoded = Db.to_barcoded(sample)
+            assert sample_barcoded
+            samples_with_metrics.append((sample, sample_barcoded))
+
+        return samples_with_metrics
+
     def _has_metrics_data(self, sequencing_id: ObjectId) -> bool:
         cached_result = ReportsGenerator.cached_sequencing_has_metrics_data.get(
             sequencing_id
@@ -124,12 +124,13 @@ class Runner:
         analysis = Analysis(sample, self.root, self.config, self.parameters)
 
         db = Db(analysis.config)
-        for filename in (tumor, normal):
-            if filename is None:
-                continue
-
-            barcoded_filename = BarcodedFilename(filename)
-            db.store_barcoded(barcoded_filename)
+        db.store_barcoded_batch(
+            [
+                BarcodedFilename(filename)
+                for filename in (tumor, normal)
+                if filename is not None
+            ]
+        )
 
         if normal is None:
             analysis.last_operation_filenames = {"sample": [tumor], "control": []}
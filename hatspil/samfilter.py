@@ -0,0 +1,260 @@
+"""The module to filter aligned reads in SAM format.
+
+After the alignment, only the reads with a small number of mismatches
+and without Ns, hard clipping or padding are kept. SAM files can easily
+reach tens of GB, therefore the filtering works on raw bytes: every
+record is split only up to the optional fields, and the NM tag is
+searched on the remaining tail as a whole.
+
+Big files can be split in byte ranges filtered by independent
+processes. The module can be run with `python -m hatspil.samfilter` in
+order to filter a file, one of its ranges or the standard input, so it
+can be used as a step of a shell pipeline.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+from fractions import Fraction
+from typing import BinaryIO, Iterable, Iterator
+
+from .core.exceptions import PipelineError
+
+BUFFER_SIZE = 1 << 23
+WRITE_CHUNK_SIZE = 1 << 22
+COPY_CHUNK_SIZE = 1 << 24
+MIN_RANGE_SIZE = 1 << 26
+DEFAULT_MAX_MISMATCHES = Fraction(1, 25)
+
+_RE_CIGAR_BAD = re.compile(rb"[NHP]")
+_RE_NM = re.compile(rb"(?:^|\t)NM:i:(\d+)(?:\s|$)")
+
+
+def filter_sam(
+    in_fd: Iterable[bytes],
+    out_fd: BinaryIO,
+    max_mismatches: Fraction = DEFAULT_MAX_MISMATCHES,
+) -> None:
+    """Filter the SAM records from a stream to another.
+
+    The header lines are always kept. A record is discarded when its
+    CIGAR contains Ns, hard clipping or padding, when it does not have
+    the NM tag or when the number of mismatches is above a fraction of
+    the length of the read, 4% by default. The comparison is performed
+    using integer arithmetic only.
+
+    The kept records are collected in memory and written in chunks of a
+    few MiB, therefore `out_fd` does not need to be buffered.
+
+    Args:
+        in_fd: the binary stream or the iterable of lines to read the
+               SAM records from.
+        out_fd: the binary stream to write the kept records to.
+        max_mismatches: the maximum fraction of mismatches of a read.
+    """
+    numerator = max_mismatches.numerator
+    denominator = max_mismatches.denominator
+    kept_lines = bytearray()
+    for line in in_fd:
+        if not line.startswith(b"@"):
+            fields = line.split(b"\t", 11)
+            if len(fields) < 12 or _RE_CIGAR_BAD.search(fields[5]):
+                continue
+
+            nm_match = _RE_NM.search(fields[11])
+            if nm_match is None:
+                continue
+
+            if int(nm_match.group(1)) * denominator > len(fields[9]) * numerator:
+                continue
+
+        kept_lines += line
+        if len(kept_lines) >= WRITE_CHUNK_SIZE:
+            out_fd.write(kept_lines)
+            kept_lines.clear()
+
+    if kept_lines:
+        out_fd.write(kept_lines)
+
+
+def _iter_range_lines(in_fd: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    if start > 0:
+        in_fd.seek(start - 1)
+        position = start - 1 + len(in_fd.readline())
+    else:
+        position = 0
+
+    for line in in_fd:
+        if position >= end:
+            break
+        yield line
+        position += len(line)
+
+
+def filter_sam_range(
+    input_filename: str,
+    output_filename: str,
+    start: int,
+    end: int,
+    max_mismatches: Fraction = DEFAULT_MAX_MISMATCHES,
+) -> None:
+    """Filter the records of a byte range of a SAM file into a file.
+
+    A line belongs to the range if its first byte is inside it,
+    therefore a set of contiguous ranges covering the whole file can be
+    filtered independently and the results can be concatenated.
+
+    Args:
+        input_filename: the SAM file to read.
+        output_filename: the file to write the kept records to.
+        start: the first byte of the range.
+        end: the byte after the last one of the range.
+        max_mismatches: the maximum fraction of mismatches of a read.
+    """
+    with open(input_filename, "rb", buffering=BUFFER_SIZE) as in_fd, open(
+        output_filename, "wb", buffering=0
+    ) as out_fd:
+        filter_sam(_iter_range_lines(in_fd, start, end), out_fd, max_mismatches)
+
+
+def filter_sam_to_stream(
+    input_filename: str,
+    out_fd: BinaryIO,
+    jobs: int = 1,
+    max_mismatches: Fraction = DEFAULT_MAX_MISMATCHES,
+) -> None:
+    """Filter the records of a SAM file into a binary stream.
+
+    See `filter_sam` for the details about the filtering. The stream can
+    be, for instance, the standard input of a process converting the
+    records to BAM, in order to avoid writing the filtered SAM to disk.
+
+    When more than one job is requested, the file is split in byte
+    ranges of at least `MIN_RANGE_SIZE` bytes, each of them is filtered
+    by a separated python process and the results are concatenated.
+    Processes are started with `subprocess`, which can be used from the
+    daemonic workers of a `multiprocessing.Pool`.
+
+    Args:
+        input_filename: the SAM file to read.
+        out_fd: the binary stream to write the kept records to.
+        jobs: the maximum number of processes to use.
+        max_mismatches: the maximum fraction of mismatches of a read.
+    """
+    size = os.path.getsize(input_filename)
+    jobs = min(jobs, size // MIN_RANGE_SIZE)
+    if jobs <= 1:
+        with open(input_filename, "rb", buffering=BUFFER_SIZE) as in_fd:
+            filter_sam(in_fd, out_fd, max_mismatches)
+        return
+
+    bounds = [size * index // jobs for index in range(jobs + 1)]
+    part_filenames = ["%s.part%d" % (input_filename, index) for index in range(jobs)]
+    try:
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "hatspil.samfilter",
+                    "--range",
+                    str(start),
+                    str(end),
+                    "--max-mismatches",
+                    str(max_mismatches),
+                    input_filename,
+                    part_filename,
+                ]
+            )
+            for start, end, part_filename in zip(bounds, bounds[1:], part_filenames)
+        ]
+        statuses = [process.wait() for process in processes]
+        for status in statuses:
+            if status != 0:
+                raise PipelineError(
+                    "SAM filtering process exited with status %d" % status
+                )
+
+        for part_filename in part_filenames:
+            with open(part_filename, "rb") as part_fd:
+                shutil.copyfileobj(part_fd, out_fd, COPY_CHUNK_SIZE)
+    finally:
+        for part_filename in part_filenames:
+            if os.path.exists(part_filename):
+                os.unlink(part_filename)
+
+
+def filter_sam_file(
+    input_filename: str,
+    output_filename: str,
+    jobs: int = 1,
+    max_mismatches: Fraction = DEFAULT_MAX_MISMATCHES,
+) -> None:
+    """Filter the records of a SAM file into another file.
+
+    See `filter_sam_to_stream` for the details.
+    """
+    with open(output_filename, "wb", buffering=0) as out_fd:
+        filter_sam_to_stream(input_filename, out_fd, jobs, max_mismatches)
+
+
+def main() -> None:
+    """Filter a SAM file or one of its ranges from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Filter the aligned reads of a SAM file."
+    )
+    parser.add_argument(
+        "input_filename", help="The SAM file to filter, '-' for the standard input."
+    )
+    parser.add_argument(
+        "output_filename",
+        help="The file for the kept reads, '-' for the standard output.",
+    )
+    parser.add_argument(
+        "--range",
+        nargs=2,
+        type=int,
+        metavar=("start", "end"),
+        help="Filter only the lines starting inside the byte range.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="The maximum number of processes to use. Default=1.",
+    )
+    parser.add_argument(
+        "--max-mismatches",
+        type=Fraction,
+        default=DEFAULT_MAX_MISMATCHES,
+        metavar="fraction",
+        help="The maximum fraction of mismatches of a read, as a decimal "
+        "number or as a ratio. Default=%s." % DEFAULT_MAX_MISMATCHES,
+    )
+    args = parser.parse_args()
+
+    if args.range is not None:
+        filter_sam_range(
+            args.input_filename, args.output_filename, *args.range, args.max_mismatches
+        )
+    elif args.input_filename == "-":
+        if args.output_filename == "-":
+            filter_sam(sys.stdin.buffer, sys.stdout.buffer, args.max_mismatches)
+        else:
+            with open(args.output_filename, "wb", buffering=0) as out_fd:
+                filter_sam(sys.stdin.buffer, out_fd, args.max_mismatches)
+    elif args.output_filename == "-":
+        filter_sam_to_stream(
+            args.input_filename, sys.stdout.buffer, args.jobs, args.max_mismatches
+        )
+    else:
+        filter_sam_file(
+            args.input_filename, args.output_filename, args.jobs, args.max_mismatches
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 """Module to handle a custom variant calling procedure."""
+import functools
 import glob
-import math
 import os
 import re
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+import cyvcf2
+import numpy as np
 import pandas as pd
-import vcf
 
 from .core import utils
 from .core.analysis import Analysis
@@ -17,6 +19,192 @@ from .core.ranges import GenomicRange, GenomicRanges
 from .db import Db
 
 
+def _get_variant_keys(
+    chromosomes: pd.Series,
+    starts: pd.Series,
+    ends: pd.Series,
+    refs: pd.Series,
+    alts: pd.Series,
+) -> pd.Series:
+    """Build the keys identifying a set of variants.
+
+    Each key has the "chr:start-end_ref_alt" format. The keys are built
+    concatenating whole columns instead of formatting each row.
+    """
+    return (
+        chromosomes.astype(str)
+        + ":"
+        + starts.astype("int64").astype(str)
+        + "-"
+        + ends.astype("int64").astype(str)
+        + "_"
+        + refs.astype(str)
+        + "_"
+        + alts.astype(str)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _read_dataset(filename: str, key: str) -> pd.DataFrame:
+    """Read a table from the HDF5 dataset, only once per process.
+
+    The returned table is shared between the callers, therefore it must
+    not be modified in place.
+    """
+    return pd.read_hdf(filename, key)
+
+
+def _get_genotype_string(genotype: List[Any]) -> str:
+    separator = "|" if genotype[-1] else "/"
+    return separator.join(
+        "." if allele < 0 else str(allele) for allele in genotype[:-1]
+    )
+
+
+def _get_overlaps_array(overlaps: List[Tuple[int, int]]) -> np.ndarray:
+    """Convert the pairs of indices of some overlaps to a 2-column array."""
+    return np.array(overlaps, dtype=np.intp).reshape(-1, 2)
+
+
+def _get_mongo_records(data: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Convert a table to a list of records that can be stored in a MongoDB.
+
+    The dots in the column names are replaced by spaces and the NaN
+    values are left out of the records.
+    """
+    records = data.rename(columns=lambda column: column.replace(".", " ")).to_dict(
+        "records"
+    )
+    return [
+        {
+            key: value
+            for key, value in record.items()
+            if type(value) is not float or value == value
+        }
+        for record in records
+    ]
+
+
+_VARSCAN_COLUMNS = [
+    "chr",
+    "start",
+    "end",
+    "width",
+    "ref",
+    "alt",
+    "totalDepth",
+    "refDepth",
+    "altDepth",
+    "sampleNames",
+    "indelError",
+    "QUAL",
+    "DP",
+    "SOMATIC",
+    "SS",
+    "SSC",
+    "GPV",
+    "SPV",
+    "GT",
+    "GQ",
+    "RD",
+    "FREQ",
+    "DP4",
+    "ADF",
+    "ADR",
+]
+
+
+def _read_varscan_vcf(filename: str) -> Tuple[Optional[bool], Dict[str, List[Any]]]:
+    """Read the data of each sample from a VarScan VCF file.
+
+    Returns:
+        A tuple with a flag telling whether the data has been obtained
+        using normals, None for a file without records, and a dict with
+        a list of values for each of the `_VARSCAN_COLUMNS`. Each sample
+        of each record is a row.
+    """
+    with_normals: Optional[bool] = None
+    columns: Dict[str, List[Any]] = {column: [] for column in _VARSCAN_COLUMNS}
+    reader = cyvcf2.VCF(filename)
+    for record in reader:
+        start = record.POS - 1
+        end = start + len(record.REF)
+        filters = record.FILTER
+        record_values = {
+            "chr": record.CHROM,
+            "start": record.POS,
+            "end": end,
+            "width": end - start,
+            "ref": record.REF,
+            "alt": ",".join(record.ALT),
+            "indelError": filters is None or "indelError" not in filters.split(";"),
+            "QUAL": record.QUAL,
+        }
+
+        if "DP4" in record.FORMAT:
+            if with_normals is False:
+                raise PipelineError("mixed varscan data with/without normals")
+            with_normals = True
+
+            record_values.update(
+                {
+                    "DP": record.INFO.get("DP"),
+                    "SOMATIC": bool(record.INFO.get("SOMATIC")),
+                    "SS": record.INFO.get("SS"),
+                    "SSC": record.INFO.get("SSC"),
+                    "GPV": record.INFO.get("GPV"),
+                    "SPV": record.INFO.get("SPV"),
+                }
+            )
+            sample_names = reader.samples
+            dp4s = [dp4.split(",") for dp4 in record.format("DP4")]
+            dp4_values = [int(dp4[0]) for dp4 in dp4s]
+            forward_depths = [int(dp4[2]) for dp4 in dp4s]
+            reverse_depths = [int(dp4[3]) for dp4 in dp4s]
+        else:
+            if with_normals is True:
+                raise PipelineError("mixed varscan data with/without normals")
+            with_normals = False
+
+            record_values.update(
+                {
+                    "DP": None,
+                    "SOMATIC": None,
+                    "SS": None,
+                    "SSC": None,
+                    "GPV": None,
+                    "SPV": None,
+                }
+            )
+            sample_names = ["TUMOR"] * len(reader.samples)
+            dp4_values = [None] * len(reader.samples)
+            forward_depths = record.format("ADF")[:, 0].tolist()
+            reverse_depths = record.format("ADR")[:, 0].tolist()
+
+        samples_count = len(sample_names)
+        for column, value in record_values.items():
+            columns[column].extend([value] * samples_count)
+
+        ref_depths = record.format("RD")[:, 0].tolist()
+        columns["totalDepth"].extend(record.format("DP")[:, 0].tolist())
+        columns["refDepth"].extend(ref_depths)
+        columns["altDepth"].extend(record.format("AD")[:, 0].tolist())
+        columns["sampleNames"].extend(sample_names)
+        columns["GT"].extend(
+            _get_genotype_string(genotype) for genotype in record.genotypes
+        )
+        columns["GQ"].extend(record.format("GQ")[:, 0].tolist())
+        columns["RD"].extend(ref_depths)
+        columns["FREQ"].extend(
+            float(frequency[:-1]) / 100 for frequency in record.format("FREQ")
+        )
+        columns["DP4"].extend(dp4_values)
+        columns["ADF"].extend(forward_depths)
+        columns["ADR"].extend(reverse_depths)
+
+    return with_normals, columns
+
+
 class VariantCalling:
     """A class to produce meaningful variant calling results.
 
@@ -34,6 +222,8 @@ class VariantCalling:
     medium_damage = 5
     high_damage = 20
     strelka_tier = 0
+    table_chunk_size = 200000
+    db_batch_size = 10000
 
     def __init__(self, analysis: Analysis) -> None:
         """Create an instance of the class.
@@ -65,7 +255,7 @@ class VariantCalling:
         )
 
         os.makedirs(self.annovar_dirname, exist_ok=True)
-        self.build_version = utils.get_human_annotation(self.analysis.config)
+        self.build_version = self.analysis.human_annotation
 
         self.annovar_file = os.path.join(
             self.annovar_dirname, self.analysis.basename + "_annovar_input"
@@ -81,6 +271,36 @@ class VariantCalling:
         """Change current directory to the variant calling folder."""
         os.chdir(self.analysis.get_out_dir())
 
+    @classmethod
+    def _read_mutect_table(cls, filename: str) -> pd.DataFrame:
+        """Read and filter the calls from a MuTect output table.
+
+        The table is read in chunks, and the calls with a low allele
+        frequency, a low coverage or a strand bias are discarded as
+        soon as each chunk is read.
+        """
+        filtered_chunks = []
+        for chunk in pd.read_table(
+            filename, comment="#", chunksize=cls.table_chunk_size
+        ):
+            strand_bias_counts = chunk.strand_bias_counts.str.extract(
+                r"(\d+)\W+(\d+)\W+(\d+)\W+(\d+)"
+            ).astype(int)
+            chunk["tot_cov"] = chunk.t_ref_count + chunk.t_alt_count
+            discarded = (
+                (chunk.tumor_f < cls.min_allele_frequency)
+                | (
+                    (chunk.judgement == "REJECT")
+                    & (chunk.failure_reasons != "possible_contamination")
+                )
+                | (strand_bias_counts[2] <= 0)
+                | (strand_bias_counts[3] <= 0)
+                | (chunk.tot_cov <= cls.min_cov_position)
+            )
+            filtered_chunks.append(chunk[~discarded])
+
+        return pd.concat(filtered_chunks)
+
     def prepare_for_annovar(self) -> None:
         """Prepare all the data for ANNOVAR.
 
@@ -96,170 +316,69 @@ class VariantCalling:
         strelka_data: Optional[pd.Table] = None
 
         if len(self.mutect_filenames) > 0:
-            for mutect_filename in self.mutect_filenames:
-                if mutect_data is None:
-                    mutect_data = pd.read_table(mutect_filename, comment="#")
-                else:
-                    mutect_data = mutect_data.join(
-                        pd.read_table(mutect_filename, comment="#")
-                    )
-
-            assert mutect_data is not None
+            with ThreadPoolExecutor(
+                max_workers=min(len(self.mutect_filenames), os.cpu_count() or 1)
+            ) as pool:
+                mutect_data = pd.concat(
+                    pool.map(self._read_mutect_table, self.mutect_filenames),
+                    ignore_index=True,
+                )
             mutect_data.insert(
                 0,
                 "key",
-                mutect_data.apply(
-                    lambda row: "%s:%d-%d_%s_%s"
-                    % (
-                        row.contig,
-                        row.position,
-                        row.position,
-                        row.ref_allele,
-                        row.alt_allele,
-                    ),
-                    axis=1,
+                _get_variant_keys(
+                    mutect_data.contig,
+                    mutect_data.position,
+                    mutect_data.position,
+                    mutect_data.ref_allele,
+                    mutect_data.alt_allele,
                 ),
             )
 
-            mutect_data.drop(
-                mutect_data[
-                    mutect_data.tumor_f < VariantCalling.min_allele_frequency
-                ].index,
-                inplace=True,
-            )
-            mutect_data.drop(
-                mutect_data[
-                    (mutect_data.judgement == "REJECT")
-                    & (mutect_data.failure_reasons != "possible_contamination")
-                ].index,
-                inplace=True,
-            )
-            mutect_data.drop(
-                mutect_data[
-                    mutect_data.strand_bias_counts.str.split(r"\W")
-                    .map(lambda values: [int(value) for value in values if value != ""])
-                    .map(lambda values: (values[2] <= 0 or values[3] <= 0))
-                ].index,
-                inplace=True,
-            )
-            mutect_data["tot_cov"] = mutect_data.t_ref_count + mutect_data.t_alt_count
-            mutect_data.drop(
-                mutect_data[
-                    mutect_data.tot_cov <= VariantCalling.min_cov_position
-                ].index,
-                inplace=True,
-            )
-
+        varscan_frames: List[pd.DataFrame] = []
         for varscan_type in ("snp", "indel"):
             filenames = self.varscan_filenames[varscan_type]
             if len(filenames) > 0:
-                withNormals = True
-                varscan_data_list: List[Dict[str, Any]] = []
-                for varscan_filename in filenames:
-                    for record in vcf.Reader(filename=varscan_filename):
-                        for sample in record.samples:
-                            sample_data = {
-                                "chr": record.CHROM,
-                                "start": record.start + 1,
-                                "end": record.end,
-                                "width": record.end - record.start,
-                                "ref": str(record.REF),
-                                "alt": ",".join([str(alt) for alt in record.ALT]),
-                                "totalDepth": sample.data.DP,
-                                "refDepth": sample.data.RD,
-                                "altDepth": sample.data.AD,
-                                "indelError": "indelError" not in record.FILTER,
-                                "QUAL": record.QUAL,
-                                "GT": sample.data.GT,
-                                "GQ": sample.data.GQ,
-                                "RD": sample.data.RD,
-                                "FREQ": float(sample.data.FREQ[:-1]) / 100,
-                            }
-
-                            if hasattr(sample.data, "DP4"):
-                                if not withNormals:
-                                    raise PipelineError(
-                                        "mixed varscan data with/without normals"
-                                    )
-                                dp4 = sample.data.DP4.split(",")
-                                sample_data.update(
-                                    {
-                                        "sampleNames": sample.sample,
-                                        "DP": record.INFO["DP"],
-                                        "SOMATIC": "SOMATIC" in record.INFO
-                                        and record.INFO["SOMATIC"],
-                                        "SS": record.INFO["SS"],
-                                        "SSC": record.INFO["SSC"],
-                                        "GPV": record.INFO["GPV"],
-                                        "SPV": record.INFO["SPV"],
-                                        "DP4": int(dp4[0]),
-                                        "ADF": int(dp4[2]),
-                                        "ADR": int(dp4[3]),
-                                    }
-                                )
-                            else:
-                                if withNormals:
-                                    if len(varscan_data_list) != 0:
-                                        raise PipelineError(
-                                            "mixed varscan data with/without normals"
-                                        )
-                                    withNormals = False
-
-                                sample_data.update(
-                                    {
-                                        "sampleNames": "TUMOR",
-                                        "DP": None,
-                                        "SOMATIC": None,
-                                        "SS": None,
-                                        "SSC": None,
-                                        "GPV": None,
-                                        "SPV": None,
-                                        "DP4": None,
-                                        "ADF": sample.data.ADF,
-                                        "ADR": sample.data.ADR,
-                                    }
-                                )
-
-                            varscan_data_list.append(sample_data)
+                with ThreadPoolExecutor(
+                    max_workers=min(len(filenames), os.cpu_count() or 1)
+                ) as pool:
+                    varscan_files_data = list(pool.map(_read_varscan_vcf, filenames))
+
+                files_with_normals = set(
+                    file_with_normals
+                    for file_with_normals, _ in varscan_files_data
+                    if file_with_normals is not None
+                )
+                if len(files_with_normals) > 1:
+                    raise PipelineError("mixed varscan data with/without normals")
+                withNormals = files_with_normals != {False}
 
                 current_data = pd.DataFrame(
-                    data=varscan_data_list,
-                    columns=[
-                        "chr",
-                        "start",
-                        "end",
-                        "width",
-                        "ref",
-                        "alt",
-                        "totalDepth",
-                        "refDepth",
-                        "altDepth",
-                        "sampleNames",
-                        "indelError",
-                        "QUAL",
-                        "DP",
-                        "SOMATIC",
-                        "SS",
-                        "SSC",
-                        "GPV",
-                        "SPV",
-                        "GT",
-                        "GQ",
-                        "RD",
-                        "FREQ",
-                        "DP4",
-                        "ADF",
-                        "ADR",
-                    ],
+                    {
+                        column: [
+                            value
+                            for _, file_columns in varscan_files_data
+                            for value in file_columns[column]
+                        ]
+                        for column in _VARSCAN_COLUMNS
+                    },
+                    columns=_VARSCAN_COLUMNS,
+                )
+                del varscan_files_data
+
+                current_data = current_data.astype(
+                    {"chr": "category", "sampleNames": "category"}
                 )
                 current_data.drop_duplicates(inplace=True)
                 if current_data.empty:
                     continue
 
-                current_data["key"] = current_data.apply(
-                    lambda row: "%s:%d-%d_%s_%s"
-                    % (row.chr, row.start, row.end, row.ref, row.alt),
-                    axis=1,
+                current_data["key"] = _get_variant_keys(
+                    current_data.chr,
+                    current_data.start,
+                    current_data.end,
+                    current_data.ref,
+                    current_data.alt,
                 )
                 tumor = current_data[current_data.sampleNames == "TUMOR"].copy()
                 tumor.reset_index(inplace=True, drop=True)
@@ -297,38 +416,40 @@ class VariantCalling:
                     )
                     tumor.drop(tumor[drop_condition].index, inplace=True)
 
-                if varscan_data is None:
-                    varscan_data = tumor
-                else:
-                    varscan_data = pd.concat((varscan_data, tumor), sort=True)
+                varscan_frames.append(tumor)
+
+        if len(varscan_frames) > 0:
+            varscan_data = pd.concat(varscan_frames, sort=False)
+        del varscan_frames
 
         if os.path.exists(self.strelka_results_dir):
             strelka_data_list = []
+            base_fields = [(base, base + "U") for base in "ACGT"]
             for strelka_type in ("snvs", "indels"):
                 passed_vcf_filename = os.path.join(
                     self.strelka_results_dir, "passed.somatic.%s.vcf" % strelka_type
                 )
-                for record in vcf.Reader(filename=passed_vcf_filename):
-                    samples = {}
-                    for sample in record.samples:
-                        if sample.sample == "NORMAL":
-                            samples["normal"] = sample
-                        elif sample.sample == "TUMOR":
-                            samples["tumor"] = sample
-
-                    tumor_data = samples["tumor"].data
+                reader = cyvcf2.VCF(passed_vcf_filename)
+                tumor_index = reader.samples.index("TUMOR")
+                tier = VariantCalling.strelka_tier
+                for record in reader:
                     if strelka_type == "snvs":
-                        coverage = (
-                            tumor_data.AU[VariantCalling.strelka_tier]
-                            + tumor_data.CU[VariantCalling.strelka_tier]
-                            + tumor_data.GU[VariantCalling.strelka_tier]
-                            + tumor_data.TU[VariantCalling.strelka_tier]
-                        )
+                        base_coverages = {
+                            base: int(record.format(field)[tumor_index, tier])
+                            for base, field in base_fields
+                        }
+                        coverage = sum(base_coverages.values())
                     else:
-                        if VariantCalling.strelka_tier == 0:
-                            coverage = tumor_data.DP
+                        if tier == 0:
+                            coverage = int(record.format("DP")[tumor_index, 0])
                         else:
-                            coverage = tumor_data.DP2
+                            coverage = int(record.format("DP2")[tumor_index, 0])
+                        reference_coverage = int(
+                            record.format("TAR")[tumor_index, tier]
+                        )
+                        alternative_coverage = int(
+                            record.format("TIR")[tumor_index, tier]
+                        )
 
                     # This is how the Strelka manual whats the frequency to be
                     # calculated. Disclaimer: this does not make sense from a
@@ -336,19 +457,8 @@ class VariantCalling:
                     # method, go ask Illumina.
                     for alternative_base in record.ALT:
                         if strelka_type == "snvs":
-                            reference_coverage = getattr(
-                                tumor_data, str(record.REF) + "U"
-                            )[VariantCalling.strelka_tier]
-                            alternative_coverage = getattr(
-                                tumor_data, str(alternative_base) + "U"
-                            )[VariantCalling.strelka_tier]
-                        else:
-                            reference_coverage = tumor_data.TAR[
-                                VariantCalling.strelka_tier
-                            ]
-                            alternative_coverage = tumor_data.TIR[
-                                VariantCalling.strelka_tier
-                            ]
+                            reference_coverage = base_coverages[record.REF]
+                            alternative_coverage = base_coverages[alternative_base]
 
                         total_coverage = reference_coverage + alternative_coverage
                         if total_coverage == 0:
@@ -376,17 +486,18 @@ class VariantCalling:
             strelka_data = None
 
         self.variants = pd.DataFrame(columns=("key", "DP", "FREQ", "method"))
+        variants_frames = []
 
         if strelka_data is None:
             strelka_data = pd.DataFrame(columns=("key", "DP", "FREQ"))
         else:
-            self.variants = pd.concat([self.variants, strelka_data], sort=True)
+            variants_frames.append(strelka_data)
 
         if varscan_data is None:
             varscan_data = pd.DataFrame(columns=("key", "DP", "FREQ"))
         else:
             varscan_data = varscan_data[["key", "DP", "FREQ"]].copy()
-            self.variants = pd.concat([self.variants, varscan_data], sort=True)
+            variants_frames.append(varscan_data)
 
         if mutect_data is None:
             mutect_data = pd.DataFrame(columns=("key", "DP", "FREQ"))
@@ -394,37 +505,32 @@ class VariantCalling:
             mutect_data = mutect_data.rename(
                 index=str, columns={"tot_cov": "DP", "tumor_f": "FREQ"}
             )[["key", "DP", "FREQ"]].copy()
-            self.variants = pd.concat([self.variants, mutect_data], sort=True)
-
-        self.variants.drop_duplicates(("key",), inplace=True)
-        methods = []
-
-        keysets = {
-            "mutect": set(mutect_data.key),
-            "varscan": set(varscan_data.key),
-            "strelka": set(strelka_data.key),
-        }
-
-        def set_methods(row: pd.Series) -> None:
-            current_methods = []
-            if row.key in keysets["mutect"]:
-                current_methods.append("Mutect1.17")
-            if row.key in keysets["varscan"]:
-                current_methods.append("VarScan2")
-            if row.key in keysets["strelka"]:
-                current_methods.append("Strelka")
+            variants_frames.append(mutect_data)
 
-            methods.append(":".join(current_methods))
+        if len(variants_frames) > 0:
+            self.variants = pd.concat([self.variants] + variants_frames, sort=False)
 
-        self.variants.apply(set_methods, axis=1)
-        self.variants.method = methods
+        self.variants.drop_duplicates(("key",), inplace=True)
+        keys = self.variants.key
+        in_mutect = keys.isin(mutect_data.key).values
+        in_varscan = keys.isin(varscan_data.key).values
+        in_strelka = keys.isin(strelka_data.key).values
+        methods = np.where(in_mutect, "Mutect1.17", "")
+        methods = np.char.add(
+            methods,
+            np.where(in_varscan, np.where(in_mutect, ":VarScan2", "VarScan2"), ""),
+        )
+        methods = np.char.add(
+            methods,
+            np.where(
+                in_strelka, np.where(in_mutect | in_varscan, ":Strelka", "Strelka"), ""
+            ),
+        )
+        self.variants["method"] = methods
 
-        with open(self.annovar_file, "w") as fd:
-            for key in self.variants.key:
-                splitted = re.split(r"[:_-]", key)
-                if len(splitted) != 5:
-                    continue
-                fd.write("%s\n" % "\t".join(splitted))
+        self.variants.key.str.extract(
+            r"^([^:_-]*)[:_-]([^:_-]*)[:_-]([^:_-]*)[:_-]([^:_-]*)[:_-]([^:_-]*)$"
+        ).dropna().to_csv(self.annovar_file, sep="\t", header=False, index=False)
 
         self.variants.to_csv(self.variants_filename, index=False)
 
@@ -474,32 +580,44 @@ class VariantCalling:
         kit = utils.get_kit_from_barcoded(self.analysis.config, barcoded_sample)
         assert kit
 
-        annotation = pd.read_table(self.multianno_filename, on_bad_lines='warn')
+        annotation = pd.concat(
+            [
+                chunk[chunk.Chr.str.match(r"chr(?:\d{1,2}|[xXyY])")]
+                for chunk in pd.read_table(
+                    self.multianno_filename,
+                    on_bad_lines="warn",
+                    chunksize=VariantCalling.table_chunk_size,
+                )
+            ]
+        )
         annotation.rename(
             index=str, columns={"avsnp151": "snp", "COSMIC100": "cosmic"}, inplace=True
         )
-        annotation = annotation[annotation.Chr.str.match(r"chr(?:\d{1,2}|[xXyY])")]
+        annotation = annotation.astype({"Chr": "category", "Func.ensGene": "category"})
         annotation.insert(
             0,
             "id",
-            annotation.apply(
-                lambda row: "%s:%d-%d_%s_%s"
-                % (row.Chr, row.Start, row.End, row.Ref, row.Alt),
-                axis=1,
+            _get_variant_keys(
+                annotation.Chr,
+                annotation.Start,
+                annotation.End,
+                annotation.Ref,
+                annotation.Alt,
             ),
         )
 
-        cancer_genes = pd.read_hdf(VariantCalling.dataset_filename, "cancer_genes")
-        panel_drug = pd.read_hdf(VariantCalling.dataset_filename, "panel_drug")
-        gene_info = pd.read_hdf(VariantCalling.dataset_filename, "gene_info")
-        gene_info.drop_duplicates(subset="symbol", inplace=True)
+        cancer_genes = _read_dataset(VariantCalling.dataset_filename, "cancer_genes")
+        panel_drug = _read_dataset(VariantCalling.dataset_filename, "panel_drug")
+        gene_info = _read_dataset(
+            VariantCalling.dataset_filename, "gene_info"
+        ).drop_duplicates(subset="symbol")
 
         selected_cancer_genes = cancer_genes[
             cancer_genes.cancer_site == kit.cancer_site
         ]
 
         annotation.reset_index(inplace=True, drop=True)
-        gene_info.reset_index(inplace=True, drop=True)
+        gene_info = gene_info.reset_index(drop=True)
         annotation["gene_type"] = annotation.merge(
             gene_info, left_on="Gene.ensGene", right_on="symbol", how="left"
         ).cancer_type.values
@@ -508,18 +626,15 @@ class VariantCalling:
         selected_symbols = annotation["Gene.ensGene"].isin(selected_cancer_genes.symbol)
         annotation.loc[selected_symbols, "cancer_gene_site"] = kit.cancer_site
 
-        annotation.loc[
-            annotation["Func.ensGene"] == "splicing", "ExonicFunc.ensGene"
-        ] = "splicing"
-        annotation.loc[
-            annotation["Func.ensGene"] == "splicing", "AAChange.ensGene"
-        ] = annotation[annotation["Func.ensGene"] == "splicing"]["GeneDetail.ensGene"]
-        annotation.loc[
-            annotation["Func.ensGene"] == "UTR3", "AAChange.ensGene"
-        ] = annotation[annotation["Func.ensGene"] == "UTR3"]["GeneDetail.ensGene"]
-        annotation.loc[
-            annotation["Func.ensGene"] == "UTR5", "AAChange.ensGene"
-        ] = annotation[annotation["Func.ensGene"] == "UTR5"]["GeneDetail.ensGene"]
+        splicing = annotation["Func.ensGene"] == "splicing"
+        with_gene_detail = splicing | annotation["Func.ensGene"].isin(("UTR3", "UTR5"))
+        annotation.loc[splicing, "ExonicFunc.ensGene"] = "splicing"
+        annotation["ExonicFunc.ensGene"] = annotation["ExonicFunc.ensGene"].astype(
+            "category"
+        )
+        annotation.loc[with_gene_detail, "AAChange.ensGene"] = annotation.loc[
+            with_gene_detail, "GeneDetail.ensGene"
+        ]
 
         annotation["Gene.ensGene"] = annotation["Gene.ensGene"].map(
             lambda value: re.split(r"[^A-Za-z0-9]", value)[0]
@@ -542,24 +657,33 @@ class VariantCalling:
             "damaging",
         ] = "High"
 
-        hgnc = pd.read_hdf(VariantCalling.dataset_filename, "hgnc")
-        hgnc.dropna(subset=("chromosome",), inplace=True)
+        hgnc = (
+            _read_dataset(VariantCalling.dataset_filename, "hgnc")
+            .dropna(subset=("chromosome",))
+            .astype({"chromosome": "category"})
+            .sort_values(["chromosome", "tstart", "tend"])
+            .reset_index(drop=True)
+        )
 
         annotation.sort_values(["Chr", "Start", "End"], inplace=True)
-        hgnc.sort_values(["chromosome", "tstart", "tend"], inplace=True)
         annotation.reset_index(drop=True, inplace=True)
-        hgnc.reset_index(drop=True, inplace=True)
 
         annotation_ranges = GenomicRanges(
             [
-                GenomicRange(row.Chr, row.Start - 1, row.End)
-                for _, row in annotation.iterrows()
+                GenomicRange(chrom, start - 1, end)
+                for chrom, start, end in zip(
+                    annotation.Chr.values,
+                    annotation.Start.values,
+                    annotation.End.values,
+                )
             ]
         )
         hgnc_ranges = GenomicRanges(
             [
-                GenomicRange(row.chromosome, row.tstart - 1, row.tend)
-                for _, row in hgnc.iterrows()
+                GenomicRange(chrom, start - 1, end)
+                for chrom, start, end in zip(
+                    hgnc.chromosome.values, hgnc.tstart.values, hgnc.tend.values
+                )
             ]
         )
 
@@ -567,21 +691,32 @@ class VariantCalling:
             raise Exception("annotation ranges expected to be not resorted")
         if hgnc_ranges.resorted:
             raise Exception("hgnc ranges expected to be not resorted")
-        overlaps = annotation_ranges.overlaps(hgnc_ranges)
+        overlaps = _get_overlaps_array(annotation_ranges.overlaps(hgnc_ranges))
         annotation.loc[
-            [index[0] for index in overlaps], "hgnc_refseq_accession"
-        ] = hgnc.loc[[index[1] for index in overlaps]].refseq_accession.tolist()
-
-        annotation["hgnc_canonical_refseq"] = annotation.apply(
-            lambda row: "|".join(
-                [
-                    ensGene
-                    for ensGene in str(row["AAChange.ensGene"]).split(",")
-                    if re.search(str(row.hgnc_refseq_accession), ensGene)
-                ]
-            ),
-            axis=1,
-        )
+            annotation.index[overlaps[:, 0]], "hgnc_refseq_accession"
+        ] = hgnc.refseq_accession.values[overlaps[:, 1]]
+
+        accession_patterns: Dict[str, Any] = {}
+        canonical_refseqs = []
+        for ens_genes, accession in zip(
+            annotation["AAChange.ensGene"].values,
+            annotation.hgnc_refseq_accession.values,
+        ):
+            accession = str(accession)
+            pattern = accession_patterns.get(accession)
+            if pattern is None:
+                pattern = re.compile(accession)
+                accession_patterns[accession] = pattern
+            canonical_refseqs.append(
+                "|".join(
+                    [
+                        ensGene
+                        for ensGene in str(ens_genes).split(",")
+                        if pattern.search(ensGene)
+                    ]
+                )
+            )
+        annotation["hgnc_canonical_refseq"] = canonical_refseqs
         empty_canonical_refseqs = annotation.hgnc_canonical_refseq == ""
         annotation.loc[empty_canonical_refseqs, "alternative_refseq"] = annotation.loc[
             empty_canonical_refseqs, "AAChange.ensGene"
@@ -600,15 +735,21 @@ class VariantCalling:
             amplicons.sort_values(["chrom", "start", "end"], inplace=True)
             amplicons_ranges = GenomicRanges(
                 [
-                    GenomicRange(row.chrom, row.start, row.end)
-                    for _, row in amplicons.iterrows()
+                    GenomicRange(chrom, start, end)
+                    for chrom, start, end in zip(
+                        amplicons.chrom.values,
+                        amplicons.start.values,
+                        amplicons.end.values,
+                    )
                 ]
             )
 
-            amplicons_overlaps = annotation_ranges.overlaps(amplicons_ranges)
+            amplicons_overlaps = _get_overlaps_array(
+                annotation_ranges.overlaps(amplicons_ranges)
+            )
             annotation["in_gene_panel"] = False
             annotation.loc[
-                set([index[0] for index in amplicons_overlaps]), "in_gene_panel"
+                annotation.index[np.unique(amplicons_overlaps[:, 0])], "in_gene_panel"
             ] = True
 
         annotation["druggable"] = annotation["Gene.ensGene"].isin(
@@ -690,23 +831,8 @@ class VariantCalling:
         if config.use_mongodb:
             from pymongo.errors import DocumentTooLarge
 
-            self.variants = pd.read_csv(self.variants_filename, index_col=False, on_bad_lines='warn')
-            variants = [
-                {
-                    key.replace(".", " "): value
-                    for key, value in variant.items()
-                    if type(value) != float or not math.isnan(value)
-                }
-                for variant in self.variants.to_dict("records")
-            ]
-            annotations = [
-                {
-                    key.replace(".", " "): value
-                    for key, value in record.items()
-                    if type(value) != float or not math.isnan(value)
-                }
-                for record in annotation.to_dict("records")
-            ]
+            variants = _get_mongo_records(self.variants)
+            annotations = _get_mongo_records(annotation)
             del annotation
             for annotation in annotations:
                 annotation.update({"assembly": self.build_version})
@@ -714,14 +840,22 @@ class VariantCalling:
             db = Db(self.analysis.config)
 
             annotation_ids: List[str] = []
-            for annotation in annotations:
-                new_annotation = db.annotations.find_or_insert(
-                    {"id": annotation["id"], "assembly": self.build_version}, annotation
+            batch_size = VariantCalling.db_batch_size
+            for batch_start in range(0, len(annotations), batch_size):
+                annotations_batch = annotations[batch_start : batch_start + batch_size]
+                new_annotations = db.annotations.find_or_insert_many(
+                    [
+                        {"id": annotation["id"], "assembly": self.build_version}
+                        for annotation in annotations_batch
+                    ],
+                    annotations_batch,
+                    projection=(),
                 )
-                assert new_annotation
-                new_annotation_id = new_annotation["_id"]
-                assert new_annotation_id
-                annotation_ids.append(new_annotation_id)
+                for new_annotation in new_annotations:
+                    assert new_annotation
+                    new_annotation_id = new_annotation["_id"]
+                    assert new_annotation_id
+                    annotation_ids.append(new_annotation_id)
 
             db_from_barcoded = db.from_barcoded(barcoded_sample)
             assert db_from_barcoded
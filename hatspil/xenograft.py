@@ -141,7 +141,7 @@ class Xenome:
 
         self.sample_base_out = os.path.join(reports_dir, self.analysis.sample)
         self.already_done: Dict[str, List[str]] = {}
-        self.human_annotation = utils.get_human_annotation(analysis.config)
+        self.human_annotation = analysis.human_annotation
         self.mouse_annotation = utils.get_mouse_annotation(analysis.config)
         self.availability_for_sample_read: Dict[int, SampleFileAvailability] = {}
         self.analyzed_files: List[str] = []
@@ -13,7 +13,7 @@ setup(
         "pandas",
         "tables",
         "numpy",
-        "PyVCF",
+        "cyvcf2",
         "plotly",
         "colorlover",
         "spectra",